@@ -1,9 +1,15 @@
 import os
 import asyncio
-import json
 import datetime
 import getpass
+import logging
+from logging.handlers import MemoryHandler
 from collections import defaultdict
+import aiohttp
+from azure.core.exceptions import AzureError
+from azure.core.pipeline.transport import AioHttpTransport
+from azure.identity.aio import DefaultAzureCredential
+from azure.mgmt.compute.aio import ComputeManagementClient
 from rich.console import Console
 from rich.progress import Progress, SpinnerColumn, BarColumn, TextColumn
 from rich.live import Live
@@ -11,6 +17,7 @@ from rich.panel import Panel
 from rich.table import Table
 
 console = Console()
+logger = logging.getLogger(__name__)
 
 # Global variables
 user_id = getpass.getuser()
@@ -21,173 +28,198 @@ summary_file = os.path.join(log_dir, f"snapshot_summary_{user_id}_{timestamp}.tx
 input_file = "snap_rid_list.txt"
 output_file = f"snapshot_resource_ids_{timestamp}.txt"
 chg_number = ""
-semaphore = asyncio.Semaphore(10)
-successful_snapshots = []
-failed_snapshots = []
+max_workers = 10
+snapshot_rid_queue = None  # Drained by snapshot_rid_writer()
 
 def write_log(message):
     console.print(message)  # Print to console for immediate feedback
-    with open(log_file, "a") as f:
-        f.write(f"{datetime.datetime.now()}: {message}\n")
+    logger.info(message)
+
+def iter_vm_info(file_path):
+    with open(file_path, 'r') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2:
+                resource_id, vm_name = parts[0], parts[1]
+                yield resource_id.split("/", 4)[2], resource_id, vm_name
+            else:
+                write_log(f"[bold yellow]Warning: Invalid line in input file: {line.strip()}[/bold yellow]")
 
-def extract_vm_info(file_path):
-    if not os.path.exists(file_path):
-        write_log(f"[bold red]Error: Input file '{file_path}' not found.[/bold red]")
-        return None
+def write_snapshot_rid(snapshot_id):
+    snapshot_rid_queue.put_nowait(snapshot_id)
 
-    vm_list = []
+async def snapshot_rid_writer(queue):
+    # Coalesce IDs arriving within 250 ms into one write; None marks the end
+    with open(output_file, "a") as f:
+        while True:
+            batch = [await queue.get()]
+            await asyncio.sleep(0.25)
+            while not queue.empty():
+                batch.append(queue.get_nowait())
+            f.writelines(f"{snapshot_id}\n" for snapshot_id in batch if snapshot_id is not None)
+            f.flush()
+            if None in batch:
+                return
+
+async def process_vm(client, resource_id, vm_name, progress, task):
+    progress.update(task, vm=f"[cyan]{vm_name}")
+    write_log(f"Processing VM: {vm_name}")
+    write_log(f"Resource ID: {resource_id}")
+
+    # Get resource group and disk ID for the VM
     try:
-        with open(file_path, 'r') as f:
-            for line in f:
-                parts = line.strip().split()
-                if len(parts) >= 2:
-                    resource_id, vm_name = parts[0], parts[1]
-                    vm_list.append((resource_id, vm_name))
-                else:
-                    write_log(f"[bold yellow]Warning: Invalid line in input file: {line.strip()}[/bold yellow]")
-    except Exception as e:
-        write_log(f"[bold red]Error reading input file: {str(e)}[/bold red]")
-        return None
-
-    if not vm_list:
-        write_log("[bold red]Error: No valid VM information found in the input file.[/bold red]")
-        return None
+        parts = resource_id.split("/")
+        resource_group = parts[4]
+        vm = await client.virtual_machines.get(resource_group, parts[8])
+        disk_id = vm.storage_profile.os_disk.managed_disk.id
+    except (AzureError, AttributeError, IndexError) as e:
+        write_log(f"Failed to get VM details for {vm_name}")
+        write_log(f"Error: {str(e)}")
+        progress.update(task, advance=1)
+        return "fail", vm_name, "Failed to get VM details"
+
+    snapshot_name = f"RH_{chg_number}_{vm_name}_{timestamp}"
+    try:
+        poller = await client.snapshots.begin_create_or_update(
+            resource_group,
+            snapshot_name,
+            {
+                "location": vm.location,
+                "creation_data": {"create_option": "Copy", "source_resource_id": disk_id},
+            },
+        )
+    except AzureError as e:
+        write_log(f"Failed to create snapshot for VM: {vm_name}")
+        write_log(f"Error: {str(e)}")
+        progress.update(task, advance=1)
+        return "fail", vm_name, "Failed to create snapshot"
 
-    return vm_list
+    # The worker moves on to the next VM while Azure finishes this snapshot
+    return asyncio.create_task(wait_for_snapshot(poller, vm_name, snapshot_name, progress, task))
 
-async def run_az_command(command, max_retries=3, delay=5):
-    for attempt in range(max_retries):
-        process = await asyncio.create_subprocess_shell(
-            command,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        stdout, stderr = await process.communicate()
-        if process.returncode == 0:
-            return stdout.decode().strip(), stderr.decode().strip(), process.returncode
+async def wait_for_snapshot(poller, vm_name, snapshot_name, progress, task):
+    try:
+        snapshot = await poller.result()
+    except AzureError as e:
+        write_log(f"Failed to create snapshot for VM: {vm_name}")
+        write_log(f"Error: {str(e)}")
+        result = "fail", vm_name, "Failed to create snapshot"
+    else:
+        write_log(f"Snapshot created: {snapshot_name}")
+
+        snapshot_id = snapshot.id
+        if snapshot_id:
+            write_snapshot_rid(snapshot_id)
+            write_log(f"Snapshot resource ID added to {output_file}: {snapshot_id}")
+            result = "ok", vm_name, snapshot_name
         else:
-            write_log(f"Command failed (attempt {attempt + 1}): {command}")
-            write_log(f"Error: {stderr.decode().strip()}")
-            if attempt < max_retries - 1:
-                write_log(f"Retrying in {delay} seconds...")
-                await asyncio.sleep(delay)
-    return "", stderr.decode().strip(), process.returncode
+            write_log(f"Warning: Could not extract snapshot resource ID for {snapshot_name}")
+            result = "fail", vm_name, "Failed to extract snapshot ID"
 
-def write_snapshot_rid(snapshot_id):
-    with open(output_file, "a") as f:
-        f.write(f"{snapshot_id}\n")
+    progress.update(task, advance=1)
+    return result
 
-async def process_vm(resource_id, vm_name, progress, task):
-    async with semaphore:
-        write_log(f"Processing VM: {vm_name}")
-        write_log(f"Resource ID: {resource_id}")
+async def vm_worker(queue, progress, task):
+    results = []
+    while not queue.empty():
+        client, resource_id, vm_name = queue.get_nowait()
+        results.append(await process_vm(client, resource_id, vm_name, progress, task))
+    return results
 
-        # Get resource group and disk ID for the VM
-        stdout, stderr, returncode = await run_az_command(
-            f"az vm show --ids {resource_id} --query '{{resourceGroup:resourceGroup, diskId:storageProfile.osDisk.managedDisk.id}}' -o json"
-        )
-        if returncode != 0:
-            write_log(f"Failed to get VM details for {vm_name}")
-            write_log(f"Error: {stderr}")
-            failed_snapshots.append((vm_name, "Failed to get VM details"))
-            progress.update(task, completed=100)
-            return
-
-        vm_details = json.loads(stdout)
-        resource_group = vm_details['resourceGroup']
-        disk_id = vm_details['diskId']
-
-        snapshot_name = f"RH_{chg_number}_{vm_name}_{timestamp}"
-        stdout, stderr, returncode = await run_az_command(
-            f"az snapshot create --name {snapshot_name} --resource-group {resource_group} --source {disk_id}"
-        )
-        
-        if returncode != 0:
-            write_log(f"Failed to create snapshot for VM: {vm_name}")
-            write_log(f"Error: {stderr}")
-            failed_snapshots.append((vm_name, "Failed to create snapshot"))
-        else:
-            write_log(f"Snapshot created: {snapshot_name}")
-            
-            snapshot_data = json.loads(stdout)
-            snapshot_id = snapshot_data.get('id')
-            if snapshot_id:
-                write_snapshot_rid(snapshot_id)
-                write_log(f"Snapshot resource ID added to {output_file}: {snapshot_id}")
-                successful_snapshots.append((vm_name, snapshot_name))
-            else:
-                write_log(f"Warning: Could not extract snapshot resource ID for {snapshot_name}")
-                failed_snapshots.append((vm_name, "Failed to extract snapshot ID"))
+async def process_subscription(client, subscription_id, vms, progress, task):
+    write_log(f"Processing subscription: {subscription_id}")
 
-        progress.update(task, completed=100)
+    # A fixed pool of workers drains the queue, bounding in-flight VMs per subscription
+    queue = asyncio.Queue()
+    for resource_id, vm_name in vms:
+        queue.put_nowait((client, resource_id, vm_name))
 
-def group_vms_by_subscription(vm_list):
-    grouped_vms = defaultdict(list)
-    for resource_id, vm_name in vm_list:
-        subscription_id = resource_id.split("/")[2]
-        grouped_vms[subscription_id].append((resource_id, vm_name))
-    return grouped_vms
+    workers = (vm_worker(queue, progress, task) for _ in range(min(max_workers, len(vms))))
+    outcomes = [outcome for worker_results in await asyncio.gather(*workers) for outcome in worker_results]
+    # Creations still in progress come back as tasks; their polls all overlap here
+    return [await outcome if isinstance(outcome, asyncio.Task) else outcome for outcome in outcomes]
 
 async def main():
-    global chg_number
+    global chg_number, snapshot_rid_queue
 
     console.print("[cyan]Azure Snapshot Creator[/cyan]")
     console.print("=========================")
 
     # Create log directory
     os.makedirs(log_dir, exist_ok=True)
+    # Records are buffered and written to the log file 100 at a time (and at exit)
+    file_handler = logging.FileHandler(log_file)
+    file_handler.setFormatter(logging.Formatter("%(asctime)s: %(message)s"))
+    logging.basicConfig(level=logging.WARNING, handlers=[MemoryHandler(100, target=file_handler)])
+    logger.setLevel(logging.INFO)  # keep the Azure SDK's per-request INFO logging out of the file
 
     # Get input from user
     chg_number = console.input("Enter the CHG number: ")
     
     write_log(f"CHG Number: {chg_number}")
 
-    vm_list = extract_vm_info(input_file)
-    if vm_list is None:
+    if not os.path.exists(input_file):
+        write_log(f"[bold red]Error: Input file '{input_file}' not found.[/bold red]")
         return
 
-    total_vms = len(vm_list)
-    write_log(f"Total VMs to process: {total_vms}")
+    grouped_vms = defaultdict(list)
+    try:
+        for subscription_id, resource_id, vm_name in iter_vm_info(input_file):
+            grouped_vms[subscription_id].append((resource_id, vm_name))
+    except Exception as e:
+        write_log(f"[bold red]Error reading input file: {str(e)}[/bold red]")
+        return
 
-    grouped_vms = group_vms_by_subscription(vm_list)
+    if not grouped_vms:
+        write_log("[bold red]Error: No valid VM information found in the input file.[/bold red]")
+        return
+
+    total_vms = sum(len(vms) for vms in grouped_vms.values())
+    write_log(f"Total VMs to process: {total_vms}")
 
     progress = Progress(
         SpinnerColumn(),
         TextColumn("[progress.description]{task.description}"),
         BarColumn(),
         TextColumn("[progress.percentage]{task.percentage:>3.0f}%"),
+        TextColumn("{task.fields[vm]}"),
         expand=True
     )
-    
-    vm_tasks = {}
-    for subscription_id, vms in grouped_vms.items():
-        for resource_id, vm_name in vms:
-            vm_tasks[vm_name] = progress.add_task(f"[cyan]{vm_name}", total=100)
-
-    overall_task = progress.add_task("[bold green]Overall Progress", total=total_vms)
-
-    with Live(Panel(progress), refresh_per_second=4) as live:
-        for subscription_id, vms in grouped_vms.items():
-            # Switch to the current subscription
-            stdout, stderr, returncode = await run_az_command(f"az account set --subscription {subscription_id}")
-            if returncode != 0:
-                write_log(f"Failed to set subscription ID: {subscription_id}")
-                write_log(f"Error: {stderr}")
-                for _, vm_name in vms:
-                    failed_snapshots.append((vm_name, "Failed to set subscription"))
-                    progress.update(vm_tasks[vm_name], completed=100)
-                    progress.update(overall_task, advance=1)
-                continue
-
-            write_log(f"Switched to subscription: {subscription_id}")
-
-            tasks = []
-            for resource_id, vm_name in vms:
-                task = asyncio.create_task(process_vm(resource_id, vm_name, progress, vm_tasks[vm_name]))
-                tasks.append(task)
-            
-            await asyncio.gather(*tasks)
-            progress.update(overall_task, advance=len(vms))
+
+    # A single bar keeps rendering cost independent of the number of VMs
+    overall_task = progress.add_task("[bold green]Overall Progress", total=total_vms, vm="")
+
+    # (status, vm_name, snapshot name or failure reason) per VM, as returned by process_vm
+    results = []
+
+    snapshot_rid_queue = asyncio.Queue()
+    rid_writer = asyncio.create_task(snapshot_rid_writer(snapshot_rid_queue))
+
+    # One authenticated client per subscription, all sharing a single aiohttp session
+    async with aiohttp.ClientSession() as session, DefaultAzureCredential() as credential:
+        transport = AioHttpTransport(session=session, session_owner=False)
+        clients = {
+            subscription_id: ComputeManagementClient(credential, subscription_id, transport=transport)
+            for subscription_id in grouped_vms
+        }
+        try:
+            with Live(Panel(progress), refresh_per_second=4) as live:
+                # Subscriptions are independent, so all of them are worked on at once
+                subscriptions = (
+                    process_subscription(clients[subscription_id], subscription_id, vms, progress, overall_task)
+                    for subscription_id, vms in grouped_vms.items()
+                )
+                for subscription_results in await asyncio.gather(*subscriptions):
+                    results.extend(subscription_results)
+        finally:
+            for client in clients.values():
+                await client.close()
+            # Make sure every created snapshot ID reaches the output file, even on Ctrl+C
+            snapshot_rid_queue.put_nowait(None)
+            await asyncio.shield(rid_writer)
+
+    successful_snapshots = [(vm, snapshot) for status, vm, snapshot in results if status == "ok"]
+    failed_snapshots = [(vm, error) for status, vm, error in results if status == "fail"]
 
     # Display summary table
     table = Table(title="Snapshot Creation Summary")
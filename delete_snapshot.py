@@ -1,9 +1,13 @@
 import os
+import re
 import time
+import asyncio
 import subprocess
-import json
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from collections import defaultdict
+import orjson
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict, namedtuple
+import aiohttp
+from azure.identity import DefaultAzureCredential
 from rich.console import Console
 from rich.progress import Progress
 from rich.table import Table
@@ -19,27 +23,49 @@ console = Console()
 logging.basicConfig(filename='azure_manager.log', level=logging.DEBUG,
                     format='%(asctime)s:%(levelname)s:%(message)s')
 
+# Subscription names rarely change, so cache them per user between runs
+_SUB_CACHE = os.path.expanduser("~/.cache/az_snap_subs.json")
+_SUB_CACHE_TTL = 24 * 60 * 60
+
+# Snapshot existence checks and deletions go straight to the ARM REST API
+ARM_ENDPOINT = "https://management.azure.com"
+ARM_SCOPE = "https://management.azure.com/.default"
+SNAPSHOT_API_VERSION = "2023-10-02"
+MAX_CONCURRENT_REQUESTS = 100
+# Throttled and transient responses are retried with exponential backoff (1s, 2s, 4s, ... capped)
+MAX_RETRIES = 3
+RETRY_BASE_DELAY = 1
+RETRY_MAX_DELAY = 30
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+_credential = None
+_arm_token = None
+_token_lock = None
+
+# The remaining az calls skip per-invocation telemetry upload and colour handling
+_AZ_ENV = {**os.environ, "AZURE_CORE_COLLECT_TELEMETRY": "no", "AZURE_CORE_NO_COLOR": "1"}
+
+# A snapshot resource ID split once into the parts used downstream
+SnapInfo = namedtuple("SnapInfo", "id sub rg name")
+_SNAPSHOT_ID_RE = re.compile(
+    r"^/subscriptions/([0-9a-f-]+)/resourceGroups/([^/]+)/providers/Microsoft\.Compute/snapshots/([^/]+)$",
+    re.IGNORECASE,
+)
+
 def run_az_command(command):
     try:
-        if isinstance(command, list):
-            result = subprocess.run(command, check=True, capture_output=True, text=True)
-            return result.stdout.strip()
-        else:
-            with subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True) as process:
-                stdout, stderr = process.communicate()
-            if process.returncode != 0:
-                return f"Error: {stderr.strip()}"
-            return stdout.strip()
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Command failed: {e.cmd}. Error: {e.stderr}")
-        raise
+        result = subprocess.run(command, capture_output=True, text=True, env=_AZ_ENV)
+        if result.returncode != 0:
+            logging.error(f"Command failed: {' '.join(command)}. Error: {result.stderr.strip()}")
+            return f"Error: {result.stderr.strip()}"
+        return result.stdout.strip()
     except Exception as e:
         logging.error(f"Error in run_az_command: {str(e)}")
         return f"Error: {str(e)}"
 
 def check_az_login():
     try:
-        result = run_az_command("az account show")
+        result = run_az_command(['az', 'account', 'show'])
         if result.startswith("Error:"):
             console.print("[yellow]You are not logged in to Azure. Please run 'az login' to authenticate.[/yellow]")
             return False
@@ -48,101 +74,226 @@ def check_az_login():
         console.print(f"[red]Error checking Azure login status: {str(e)}[/red]")
         return False
 
+def _load_subscription_cache(user_id):
+    try:
+        with open(_SUB_CACHE, 'rb') as f:
+            entry = orjson.loads(f.read()).get(user_id)
+    except (OSError, ValueError):
+        return None
+    if not entry or time.time() - entry.get('fetched_at', 0) > _SUB_CACHE_TTL:
+        return None
+    return entry.get('subscriptions')
+
+def _save_subscription_cache(user_id, subscription_names):
+    try:
+        with open(_SUB_CACHE, 'rb') as f:
+            cache = orjson.loads(f.read())
+    except (OSError, ValueError):
+        cache = {}
+    cache[user_id] = {'fetched_at': time.time(), 'subscriptions': subscription_names}
+    try:
+        os.makedirs(os.path.dirname(_SUB_CACHE), exist_ok=True)
+        with open(_SUB_CACHE, 'wb') as f:
+            f.write(orjson.dumps(cache))
+    except OSError as e:
+        logging.warning(f"Could not write subscription cache {_SUB_CACHE}: {str(e)}")
+
 def get_subscription_names():
-    command = "az account list --query '[].{id:id, name:name}' -o json"
-    result = run_az_command(command)
+    user_id = getpass.getuser()
+    cached = _load_subscription_cache(user_id)
+    if cached:
+        return cached
+
+    result = run_az_command(['az', 'account', 'list', '--query', '[].{id:id, name:name}', '-o', 'json'])
     if result and not result.startswith("Error:"):
-        subscriptions = json.loads(result)
-        return {sub['id']: sub['name'] for sub in subscriptions}
+        subscriptions = orjson.loads(result)
+        subscription_names = {sub['id']: sub['name'] for sub in subscriptions}
+        _save_subscription_cache(user_id, subscription_names)
+        return subscription_names
     return {}
 
-def switch_subscription(subscription, current_subscription):
-    if subscription != current_subscription:
-        try:
-            run_az_command(['az', 'account', 'set', '--subscription', subscription])
-            console.print(f"[green]✔ Switched to subscription: {subscription}[/green]")
-            return subscription
-        except Exception as e:
-            logging.error(f"Failed to switch to subscription {subscription}: {str(e)}")
-            raise
-    return current_subscription
+def parse_snapshot_id(snapshot_id):
+    match = _SNAPSHOT_ID_RE.match(snapshot_id)
+    if not match:
+        return None
+    return SnapInfo(snapshot_id, *match.groups())
 
-def get_resource_groups_from_snapshots(snapshot_ids):
-    resource_groups = set()
-    for snapshot_id in snapshot_ids:
-        parts = snapshot_id.split('/')
-        if len(parts) >= 5:
-            resource_groups.add((parts[2], parts[4]))  # (subscription_id, resource_group)
-    return resource_groups
+def get_resource_groups_from_snapshots(snapshots):
+    return {(snapshot.sub, snapshot.rg) for snapshot in snapshots}  # (subscription_id, resource_group)
+
+def remove_scope_lock(subscription_id, resource_group, lock_name):
+    result = run_az_command(['az', 'lock', 'delete', '--name', lock_name, '--resource-group', resource_group, '--subscription', subscription_id])
+    if not result.startswith("Error:"):
+        console.print(f"[green]✔ Removed lock '{lock_name}' from resource group '{resource_group}'[/green]")
+        return True
+    console.print(f"[red]Failed to remove lock '{lock_name}' from resource group '{resource_group}': {result}[/red]")
+    return False
 
 def check_and_remove_scope_locks(resource_groups):
-    removed_locks = []
-    current_subscription = None
+    resource_groups_by_subscription = defaultdict(dict)
     for subscription_id, resource_group in resource_groups:
-        current_subscription = switch_subscription(subscription_id, current_subscription)
-        command = f"az lock list --resource-group {resource_group} --query '[].{{name:name, level:level}}' -o json"
-        locks = json.loads(run_az_command(command))
-        for lock in locks:
-            if lock['level'] == 'CanNotDelete':
-                remove_command = f"az lock delete --name {lock['name']} --resource-group {resource_group}"  
-                result = run_az_command(remove_command)
-                if not result.startswith("Error:"):
-                    removed_locks.append((subscription_id, resource_group, lock['name']))
-                    console.print(f"[green]✔ Removed lock '{lock['name']}' from resource group '{resource_group}'[/green]")
-                else:
-                    console.print(f"[red]Failed to remove lock '{lock['name']}' from resource group '{resource_group}': {result}[/red]")
+        resource_groups_by_subscription[subscription_id][resource_group.lower()] = resource_group
+
+    # One lock listing per subscription, filtered locally by resource group
+    locks_to_remove = []
+    for subscription_id, wanted_groups in resource_groups_by_subscription.items():
+        result = run_az_command(['az', 'lock', 'list', '--subscription', subscription_id, '--query', '[].{name:name, level:level, resourceGroup:resourceGroup}', '-o', 'json'])
+        if result.startswith("Error:"):
+            console.print(f"[red]Failed to list locks in subscription '{subscription_id}': {result}[/red]")
+            continue
+        for lock in orjson.loads(result):
+            resource_group = wanted_groups.get((lock.get('resourceGroup') or '').lower())
+            if resource_group and lock['level'] == 'CanNotDelete':
+                locks_to_remove.append((subscription_id, resource_group, lock['name']))
+
+    removed_locks = []
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        removed = executor.map(lambda lock: remove_scope_lock(*lock), locks_to_remove)
+        for lock, success in zip(locks_to_remove, removed):
+            if success:
+                removed_locks.append(lock)
     return removed_locks
 
-def check_snapshot_exists(snapshot_id):
-    command = f"az snapshot show --ids {snapshot_id}"
-    result = run_az_command(command)
-    return not result.startswith("Error:")
+def get_arm_token(refresh=False):
+    global _credential, _arm_token
+    if _arm_token is None or refresh:
+        if _credential is None:
+            _credential = DefaultAzureCredential()
+        _arm_token = _credential.get_token(ARM_SCOPE).token
+    return _arm_token
+
+async def refresh_arm_token(rejected):
+    # Requests rejected together wait on one off-loop refresh and reuse its result
+    async with _token_lock:
+        if _arm_token == rejected:
+            await asyncio.get_running_loop().run_in_executor(None, get_arm_token, True)
+    return _arm_token
+
+def _retry_after(headers, default):
+    # ARM may send Retry-After as an HTTP-date; only whole seconds are used
+    retry_after = headers.get("Retry-After", "")
+    return int(retry_after) if retry_after.isdigit() else default
+
+async def arm_request(session, semaphore, method, url):
+    if url.startswith('/'):
+        url = ARM_ENDPOINT + url
+    token = _arm_token
+    refreshed = False
+    retries = 0
+    while True:
+        async with semaphore:
+            async with session.request(method, url, headers={"Authorization": f"Bearer {token}"}) as response:
+                body = await response.read()
+                status, headers = response.status, response.headers
+        # An expired token is refreshed once before giving up
+        if status == 401 and not refreshed:
+            token = await refresh_arm_token(token)
+            refreshed = True
+            continue
+        # Backoff happens outside the semaphore so a throttled request doesn't hold a slot while it waits
+        if status in RETRYABLE_STATUSES and retries < MAX_RETRIES:
+            delay = _retry_after(headers, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** retries))
+            logging.warning(f"{method} {url} returned HTTP {status}, retrying in {delay}s")
+            await asyncio.sleep(delay)
+            retries += 1
+            continue
+        return status, headers, body
+
+async def wait_for_operation(session, semaphore, headers):
+    async_operation_url = headers.get("Azure-AsyncOperation")
+    location_url = headers.get("Location")
+    delay = _retry_after(headers, 5)
+    while async_operation_url or location_url:
+        await asyncio.sleep(delay)
+        if async_operation_url:
+            status, headers, body = await arm_request(session, semaphore, "GET", async_operation_url)
+            if status != 200:
+                return False
+            operation_status = orjson.loads(body).get("status")
+            if operation_status == "Succeeded":
+                return True
+            if operation_status in ("Failed", "Canceled"):
+                return False
+        else:
+            status, headers, _ = await arm_request(session, semaphore, "GET", location_url)
+            if status != 202:
+                return status in (200, 204)
+        delay = _retry_after(headers, delay)
+    return True
+
+async def snapshot_exists(session, semaphore, snapshot_id):
+    status, _, _ = await arm_request(session, semaphore, "GET", f"{snapshot_id}?api-version={SNAPSHOT_API_VERSION}")
+    return status == 200
+
+async def run_arm_operations(operation, snapshot_ids, progress, task):
+    # Acquire the token once up front instead of racing every request for it
+    global _token_lock
+    await asyncio.get_running_loop().run_in_executor(None, get_arm_token)
+    # Each asyncio.run gets its own loop, so the refresh lock is created per run
+    _token_lock = asyncio.Lock()
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    connector = aiohttp.TCPConnector(limit=MAX_CONCURRENT_REQUESTS, keepalive_timeout=75)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        async def run(snapshot_id):
+            try:
+                return await operation(session, semaphore, snapshot_id)
+            finally:
+                progress.update(task, advance=1)
 
-def process_snapshot(snapshot_id, subscription_names):
-    try:
-        parts = snapshot_id.split('/')
-        if len(parts) < 9:
-            logging.error(f"Invalid snapshot ID format: {snapshot_id}")
-            return None, "invalid", (snapshot_id, "Invalid snapshot ID format")
+        return await asyncio.gather(*(run(snapshot_id) for snapshot_id in snapshot_ids), return_exceptions=True)
 
-        subscription_id = parts[2]
-        subscription_name = subscription_names.get(subscription_id, subscription_id)
-        snapshot_name = parts[-1]
+def get_existing_snapshot_ids(snapshots):
+    snapshot_ids = [snapshot.id for snapshot in snapshots]
+    existing_snapshots = set()
 
-        # Check if snapshot exists
-        if not check_snapshot_exists(snapshot_id):
-            return subscription_name, "non-existent", snapshot_name
+    with Progress() as progress:
+        task = progress.add_task("[cyan]Pre-validating snapshots...", total=len(snapshot_ids))
+        outcomes = asyncio.run(run_arm_operations(snapshot_exists, snapshot_ids, progress, task))
 
-        return subscription_name, "valid", snapshot_name
-    except Exception as e:
-        logging.error(f"Error processing snapshot {snapshot_id}: {str(e)}")
-        return None, "error", (snapshot_id, str(e))
+    for snapshot_id, outcome in zip(snapshot_ids, outcomes):
+        if isinstance(outcome, Exception):
+            logging.error(f"Error checking snapshot {snapshot_id}: {str(outcome)}")
+        elif outcome:
+            existing_snapshots.add(snapshot_id.lower())
+
+    return existing_snapshots
 
-def delete_snapshot(snapshot_id):
-    command = f"az snapshot delete --ids {snapshot_id}"
-    result = run_az_command(command)
-    return not result.startswith("Error:")
+def check_snapshot_exists(snapshot_id, existing_snapshots):
+    return snapshot_id.lower() in existing_snapshots
+
+def process_snapshot(snapshot, subscription_names, existing_snapshots):
+    subscription_name = subscription_names.get(snapshot.sub, snapshot.sub)
+    if not check_snapshot_exists(snapshot.id, existing_snapshots):
+        return subscription_name, "non-existent", snapshot.name
+    return subscription_name, "valid", snapshot.name
+
+async def delete_snapshot(session, semaphore, snapshot_id):
+    status, headers, _ = await arm_request(session, semaphore, "DELETE", f"{snapshot_id}?api-version={SNAPSHOT_API_VERSION}")
+    if status == 202:
+        # Wait for the deletion to finish so scope locks are not restored underneath it
+        return await wait_for_operation(session, semaphore, headers)
+    return status in (200, 204)
 
 def pre_validate_snapshots(snapshot_ids, subscription_names):
     valid_snapshots = []
     results = defaultdict(lambda: defaultdict(list))
 
-    with Progress() as progress:
-        task = progress.add_task("[cyan]Pre-validating snapshots...", total=len(snapshot_ids))
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            future_to_snapshot = {executor.submit(process_snapshot, snapshot_id, subscription_names): snapshot_id for snapshot_id in snapshot_ids}
-            for future in as_completed(future_to_snapshot):
-                try:
-                    subscription_name, status, data = future.result()
-                    if subscription_name:
-                        results[subscription_name][status].append(data)
-                        if status == "valid":
-                            valid_snapshots.append(future_to_snapshot[future])
-                    else:
-                        results["Unknown"][status].append(data)
-                except Exception as e:
-                    logging.error(f"Error processing future: {str(e)}")
-                progress.update(task, advance=1)
+    # Parse every ID once; the SnapInfo tuples are what flows downstream
+    snapshots = []
+    for snapshot_id in snapshot_ids:
+        snapshot = parse_snapshot_id(snapshot_id)
+        if snapshot is None:
+            logging.error(f"Invalid snapshot ID format: {snapshot_id}")
+            results["Unknown"]["invalid"].append((snapshot_id, "Invalid snapshot ID format"))
+        else:
+            snapshots.append(snapshot)
+
+    existing_snapshots = get_existing_snapshot_ids(snapshots)
+    for snapshot in snapshots:
+        subscription_name, status, data = process_snapshot(snapshot, subscription_names, existing_snapshots)
+        results[subscription_name][status].append(data)
+        if status == "valid":
+            valid_snapshots.append(snapshot)
 
     return valid_snapshots, results
 
@@ -151,40 +302,33 @@ def delete_valid_snapshots(valid_snapshots, subscription_names):
 
     with Progress() as progress:
         task = progress.add_task("[cyan]Deleting valid snapshots...", total=len(valid_snapshots))
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            future_to_snapshot = {executor.submit(delete_snapshot, snapshot_id): snapshot_id for snapshot_id in valid_snapshots}
-            for future in as_completed(future_to_snapshot):
-                snapshot_id = future_to_snapshot[future]
-                try:
-                    success = future.result()
-                    parts = snapshot_id.split('/')
-                    subscription_id = parts[2]
-                    subscription_name = subscription_names.get(subscription_id, subscription_id)
-                    snapshot_name = parts[-1]
-                    if success:
-                        results[subscription_name]["deleted"].append(snapshot_name)
-                    else:
-                        results[subscription_name]["failed"].append((snapshot_name, "Deletion failed"))     
-                except Exception as e:
-                    logging.error(f"Error deleting snapshot {snapshot_id}: {str(e)}")
-                    results["Unknown"]["error"].append((snapshot_id, str(e)))
-                progress.update(task, advance=1)
+        outcomes = asyncio.run(run_arm_operations(delete_snapshot, [snapshot.id for snapshot in valid_snapshots], progress, task))
+
+    for snapshot, outcome in zip(valid_snapshots, outcomes):
+        if isinstance(outcome, Exception):
+            logging.error(f"Error deleting snapshot {snapshot.id}: {str(outcome)}")
+            results["Unknown"]["error"].append((snapshot.id, str(outcome)))
+            continue
+        subscription_name = subscription_names.get(snapshot.sub, snapshot.sub)
+        if outcome:
+            results[subscription_name]["deleted"].append(snapshot.name)
+        else:
+            results[subscription_name]["failed"].append((snapshot.name, "Deletion failed"))
 
     return results
 
+def restore_scope_lock(subscription_id, resource_group, lock_name):
+    result = run_az_command(['az', 'lock', 'create', '--name', lock_name, '--resource-group', resource_group, '--lock-type', 'CanNotDelete', '--subscription', subscription_id])
+    if not result.startswith("Error:"):
+        console.print(f"[green]✔ Restored lock '{lock_name}' to resource group '{resource_group}'[/green]")
+        return True
+    console.print(f"[red]Failed to restore lock '{lock_name}' to resource group '{resource_group}': {result}[/red]")
+    return False
+
 def restore_scope_locks(removed_locks):
-    current_subscription = None
-    restored_locks = 0
-    for subscription_id, resource_group, lock_name in removed_locks:
-        current_subscription = switch_subscription(subscription_id, current_subscription)
-        command = f"az lock create --name {lock_name} --resource-group {resource_group} --lock-type CanNotDelete"
-        result = run_az_command(command)
-        if not result.startswith("Error:"):
-            console.print(f"[green]✔ Restored lock '{lock_name}' to resource group '{resource_group}'[/green]")
-            restored_locks += 1
-        else:
-            console.print(f"[red]Failed to restore lock '{lock_name}' to resource group '{resource_group}': {result}[/red]")
-    return restored_locks
+    # Each call names its subscription, so locks across subscriptions are restored concurrently
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        return sum(executor.map(lambda lock: restore_scope_lock(*lock), removed_locks))
 
 def print_summary(results):
     table = Table(title="Summary")
@@ -243,17 +387,17 @@ def print_detailed_info(results):
                 console.print(f"  [green]• {snapshot}[/green]")
 
 def export_to_csv(results, filename):
-    with open(filename, 'w', newline='') as csvfile:
+    # Entries under the other statuses are (snapshot, error) pairs
+    rows = [
+        (subscription, status, snapshot, '') if status in ('deleted', 'non-existent', 'valid') else (subscription, status, *snapshot)
+        for subscription, data in results.items()
+        for status, snapshots in data.items()
+        for snapshot in snapshots
+    ]
+    with open(filename, 'w', newline='', buffering=1 << 20) as csvfile:
         csvwriter = csv.writer(csvfile)
         csvwriter.writerow(['Subscription', 'Status', 'Snapshot', 'Error'])
-        for subscription, data in results.items():
-            for status, snapshots in data.items():
-                if status in ['deleted', 'non-existent', 'valid']:
-                    for snapshot in snapshots:
-                        csvwriter.writerow([subscription, status, snapshot, ''])
-                else:
-                    for snapshot, error in snapshots:
-                        csvwriter.writerow([subscription, status, snapshot, error])
+        csvwriter.writerows(rows)
     console.print(f"[green]✔ Results exported to {filename}[/green]")
 
 def main():
@@ -278,11 +422,17 @@ def main():
 
         try:
             with open(filename, 'r') as f:
-                snapshot_ids = f.read().splitlines()
+                lines = f.read().splitlines()
         except Exception as e:
             console.print(f"[bold red]Error reading file {filename}: {e}[/bold red]")
             return
 
+        # Skip blank lines and repeated IDs so each snapshot is only checked and deleted once
+        snapshot_ids = list(dict.fromkeys(line.strip() for line in lines if line.strip()))
+        duplicates = sum(1 for line in lines if line.strip()) - len(snapshot_ids)
+        if duplicates:
+            console.print(f"[yellow]Skipping {duplicates} duplicate snapshot IDs.[/yellow]")
+
         if len(snapshot_ids) > 100:
             confirm = console.input(f"[yellow]You are about to process {len(snapshot_ids)} snapshots. Are you sure you want to proceed? (y/n): [/yellow]")
             if confirm.lower() != 'y':
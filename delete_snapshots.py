@@ -1,260 +1,540 @@
 # delete_snapshots.py
 
 import os
+import random
 import time
-import subprocess
-import json
+import asyncio
+import sys
 import logging
-import traceback
-from datetime import datetime
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
 from typing import List, Dict, Any
+from urllib.parse import quote
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+from azure.core.exceptions import AzureError, ClientAuthenticationError
+from azure.core.pipeline.transport import AioHttpTransport
+from azure.identity import DefaultAzureCredential
+from azure.identity.aio import DefaultAzureCredential as AsyncDefaultAzureCredential
+from azure.mgmt.compute.aio import ComputeManagementClient
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# orjson parses ARM responses several times faster; the stdlib is the fallback
+if orjson:
+    json_loads = orjson.loads
+    def json_dumps(obj):
+        return orjson.dumps(obj).decode()
+else:
+    import json
+    json_loads = json.loads
+    json_dumps = json.dumps
 
 # Set up logging
 logging.basicConfig(filename='azure_manager.log', level=logging.DEBUG,
                     format='%(asctime)s:%(levelname)s:%(message)s')
 
-def run_az_command(command):
-    try:
-        if isinstance(command, list):
-            result = subprocess.run(command, check=True, capture_output=True, text=True)
-            return result.stdout.strip()
-        else:
-            with subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True) as process:
-                stdout, stderr = process.communicate()
-            if process.returncode != 0:
-                return f"Error: {stderr.strip()}"
-            return stdout.strip()
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Command failed: {e.cmd}. Error: {e.stderr}")
-        raise
-    except Exception as e:
-        logging.error(f"Error in run_az_command: {str(e)}")
-        return f"Error: {str(e)}"
+# Run reports go here; the directory is created once at import
+LOGS_DIR = Path("logs")
+LOGS_DIR.mkdir(exist_ok=True)
+
+# Upper bound on snapshot deletions in flight per subscription (keeps well under ARM write limits)
+MAX_DELETES_PER_SUBSCRIPTION = 16
+# Throttled (429) and transient 5xx deletions are retried by the SDK, which honours Retry-After
+DELETE_RETRY_TOTAL = 5
+DELETE_RETRY_BACKOFF = 1.0
+# Threads used for the blocking lock REST calls, across all subscriptions at once
+MAX_LOCK_WORKERS = 16
+
+# Existence checks are bundled into ARM batch requests
+ARM_ENDPOINT = "https://management.azure.com"
+ARM_SCOPE = "https://management.azure.com/.default"
+BATCH_API_VERSION = "2020-06-01"
+SNAPSHOT_API_VERSION = "2023-04-02"
+SUBSCRIPTION_API_VERSION = "2022-12-01"
+LOCK_API_VERSION = "2016-09-01"
+ARM_BATCH_SIZE = 500
+
+# Throttled (429) and transient 5xx ARM responses, and dropped connections, are retried in _arm_request
+ARM_RETRY_STATUSES = {429, 500, 502, 503, 504}
+ARM_MAX_ATTEMPTS = 6
+ARM_BACKOFF_INITIAL = 1
+ARM_BACKOFF_MAX = 30
+
+# All ARM REST calls share one keep-alive connection pool
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=64))
+# Tokens come from an in-process credential and are only kept in memory, never on disk
+_credential = None
+_arm_token = None
 
 def check_az_login():
     try:
-        result = run_az_command("az account show")
-        if result.startswith("Error:"):
-            logging.warning("Not logged in to Azure.")
-            return False
+        get_arm_token()
         return True
+    except ClientAuthenticationError as e:
+        logging.warning(f"Not logged in to Azure: {str(e)}")
+        return False
     except Exception as e:
         logging.error(f"Error checking Azure login status: {str(e)}")
         return False
 
 def get_subscription_names():
-    command = "az account list --query '[].{id:id, name:name}' -o json"
-    result = run_az_command(command)
-    if result and not result.startswith("Error:"):
-        subscriptions = json.loads(result)
-        return {sub['id']: sub['name'] for sub in subscriptions}
-    return {}
-
-def switch_subscription(subscription, current_subscription):
-    if subscription != current_subscription:
-        try:
-            run_az_command(['az', 'account', 'set', '--subscription', subscription])
-            logging.info(f"Switched to subscription: {subscription}")
-            return subscription
-        except Exception as e:
-            logging.error(f"Failed to switch to subscription {subscription}: {str(e)}")
-            raise
-    return current_subscription
-
-def get_resource_groups_from_snapshots(snapshot_ids):
-    resource_groups = set()
+    subscription_names = {}
+    url = f"{ARM_ENDPOINT}/subscriptions?api-version={SUBSCRIPTION_API_VERSION}"
+    try:
+        while url:
+            response = _arm_request("GET", url)
+            response.raise_for_status()
+            page = json_loads(response.content)
+            for sub in page.get("value", []):
+                subscription_names[sub['subscriptionId']] = sub['displayName']
+            url = page.get("nextLink")
+    except (requests.RequestException, AzureError) as e:
+        logging.error(f"Failed to list subscriptions: {str(e)}")
+        return {}
+    return subscription_names
+
+@dataclass
+class ParsedIds:
+    # Snapshot IDs split once into parallel lists; index i describes the same snapshot in each
+    full: List[str] = field(default_factory=list)
+    sub: List[str] = field(default_factory=list)
+    rg: List[str] = field(default_factory=list)
+    name: List[str] = field(default_factory=list)
+
+    def append(self, full, sub, rg, name):
+        self.full.append(full)
+        self.sub.append(sub)
+        self.rg.append(rg)
+        self.name.append(name)
+
+def parse_snapshot_ids(snapshot_ids):
+    parsed = ParsedIds()
+    invalid_ids = []
     for snapshot_id in snapshot_ids:
         parts = snapshot_id.split('/')
-        if len(parts) >= 5:
-            resource_groups.add((parts[2], parts[4]))  # (subscription_id, resource_group)
-    return resource_groups
+        if len(parts) < 9:
+            logging.error(f"Invalid snapshot ID format: {snapshot_id}")
+            invalid_ids.append(snapshot_id)
+            continue
+        parsed.append(snapshot_id, parts[2], parts[4], parts[-1])
+    return parsed, invalid_ids
+
+def group_by_subscription(parsed):
+    by_sub = defaultdict(list)
+    for i, subscription_id in enumerate(parsed.sub):
+        by_sub[subscription_id].append(i)
+    return by_sub
+
+def get_resource_groups_from_snapshots(parsed, by_sub):
+    # (subscription_id, resource_group)
+    return {(subscription_id, parsed.rg[i]) for subscription_id, indices in by_sub.items() for i in indices}
+
+def lock_url(subscription_id, resource_group, lock_name):
+    # The subscription is part of every lock URL, so no global 'az account set' is needed
+    return (f"{ARM_ENDPOINT}/subscriptions/{subscription_id}/resourceGroups/{resource_group}"
+            f"/providers/Microsoft.Authorization/locks/{quote(lock_name, safe='')}?api-version={LOCK_API_VERSION}")
+
+def list_subscription_locks(subscription_id):
+    locks = []
+    url = f"{ARM_ENDPOINT}/subscriptions/{subscription_id}/providers/Microsoft.Authorization/locks?api-version={LOCK_API_VERSION}"
+    try:
+        while url:
+            response = _arm_request("GET", url)
+            response.raise_for_status()
+            page = json_loads(response.content)
+            locks.extend(page.get("value", []))
+            url = page.get("nextLink")
+    except (requests.RequestException, AzureError) as e:
+        logging.error(f"Failed to list locks for subscription '{subscription_id}': {str(e)}")
+    return locks
+
+def remove_scope_lock(subscription_id, resource_group, lock_name):
+    try:
+        response = _arm_request("DELETE", lock_url(subscription_id, resource_group, lock_name))
+        response.raise_for_status()
+        logging.info(f"Removed lock '{lock_name}' from resource group '{resource_group}'")
+        return True
+    except (requests.RequestException, AzureError) as e:
+        logging.error(f"Failed to remove lock '{lock_name}' from resource group '{resource_group}': {str(e)}")
+        return False
 
-def check_and_remove_scope_locks(resource_groups):
-    removed_locks = []
-    current_subscription = None
+async def check_and_remove_scope_locks(resource_groups):
+    groups_by_subscription = defaultdict(set)
     for subscription_id, resource_group in resource_groups:
-        current_subscription = switch_subscription(subscription_id, current_subscription)
-        command = f"az lock list --resource-group {resource_group} --query '[].{{name:name, level:level}}' -o json"
-        locks = json.loads(run_az_command(command))
-        for lock in locks:
-            if lock['level'] == 'CanNotDelete':
-                remove_command = f"az lock delete --name {lock['name']} --resource-group {resource_group}"
-                result = run_az_command(remove_command)
-                if not result.startswith("Error:"):
-                    removed_locks.append((subscription_id, resource_group, lock['name']))
-                    logging.info(f"Removed lock '{lock['name']}' from resource group '{resource_group}'")
+        groups_by_subscription[subscription_id].add(resource_group.lower())
+    subscription_ids = list(groups_by_subscription)
+
+    loop = asyncio.get_running_loop()
+    # One lock listing per subscription, filtered to the affected resource groups locally;
+    # all subscriptions are handled in parallel and the pool size bounds concurrency
+    with ThreadPoolExecutor(max_workers=MAX_LOCK_WORKERS) as executor:
+        locks_per_subscription = await asyncio.gather(*(
+            loop.run_in_executor(executor, list_subscription_locks, subscription_id)
+            for subscription_id in subscription_ids
+        ))
+        locks_by_rg = defaultdict(list)
+        for subscription_id, subscription_locks in zip(subscription_ids, locks_per_subscription):
+            affected_groups = groups_by_subscription[subscription_id]
+            # Level first: ReadOnly locks are dropped before their IDs are split
+            for lock in subscription_locks:
+                if lock['properties']['level'] != 'CanNotDelete':
+                    continue
+                # Resource group scope: /subscriptions/{sub}/resourceGroups/{rg}/providers/Microsoft.Authorization/locks/{name}
+                parts = lock['id'].split('/')
+                if len(parts) == 9 and parts[3].lower() == 'resourcegroups' and parts[4].lower() in affected_groups:
+                    locks_by_rg[(subscription_id, parts[4])].append(lock['name'])
+        # The common case: nothing is locked, so there is nothing to remove (or restore later)
+        if not locks_by_rg:
+            return []
+        locks = [
+            (subscription_id, resource_group, lock_name)
+            for (subscription_id, resource_group), lock_names in locks_by_rg.items()
+            for lock_name in lock_names
+        ]
+        removed = await asyncio.gather(*(loop.run_in_executor(executor, remove_scope_lock, *lock) for lock in locks))
+    return [lock for lock, success in zip(locks, removed) if success]
+
+def get_arm_token(refresh=False):
+    global _credential, _arm_token
+    if _arm_token is None or refresh:
+        if _credential is None:
+            _credential = DefaultAzureCredential()
+        _arm_token = _credential.get_token(ARM_SCOPE).token
+    return _arm_token
+
+def _retry_delay(attempt, response=None):
+    # Honour Retry-After when ARM sends it, otherwise back off exponentially with full jitter
+    if response is not None:
+        retry_after = response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return int(retry_after)
+    return random.uniform(0, min(ARM_BACKOFF_MAX, ARM_BACKOFF_INITIAL * 2 ** attempt))
+
+def _arm_request(method, url, **kwargs):
+    # The bearer token is fetched on first use and refreshed only when ARM rejects it
+    token = get_arm_token()
+    refreshed = False
+    for attempt in range(ARM_MAX_ATTEMPTS):
+        last_attempt = attempt == ARM_MAX_ATTEMPTS - 1
+        try:
+            response = _session.request(method, url, headers={"Authorization": f"Bearer {token}"}, **kwargs)
+        except requests.ConnectionError as e:
+            if last_attempt:
+                raise
+            logging.warning(f"{method} {url} failed ({str(e)}), retrying")
+            time.sleep(_retry_delay(attempt))
+            continue
+        if response.status_code == 401 and not refreshed:
+            token = get_arm_token(refresh=True)
+            refreshed = True
+            continue
+        if response.status_code in ARM_RETRY_STATUSES and not last_attempt:
+            logging.warning(f"{method} {url} returned {response.status_code}, retrying")
+            time.sleep(_retry_delay(attempt, response))
+            continue
+        return response
+    return response
+
+def _run_batch(batch):
+    payload = {"requests": [
+        {"httpMethod": "GET", "url": f"{ARM_ENDPOINT}{snapshot_id}?api-version={SNAPSHOT_API_VERSION}", "name": str(i)}
+        for i, snapshot_id in enumerate(batch)
+    ]}
+    response = _arm_request("POST", f"{ARM_ENDPOINT}/batch?api-version={BATCH_API_VERSION}", json=payload)
+    # ARM answers 202 when the batch takes a while; poll until it is complete
+    attempt = 0
+    while response.status_code == 202:
+        location = response.headers.get("Location")
+        if not location:
+            raise requests.HTTPError("Batch accepted without a Location to poll", response=response)
+        time.sleep(_retry_delay(attempt, response))
+        response = _arm_request("GET", location)
+        attempt += 1
+    response.raise_for_status()
+    return json_loads(response.content).get("responses", [])
+
+def check_snapshots_exist(snapshot_ids):
+    # True/False per checked ID; IDs that could not be checked are left out and reported as errors
+    exists_map = {}
+    for start in range(0, len(snapshot_ids), ARM_BATCH_SIZE):
+        pending = snapshot_ids[start:start + ARM_BATCH_SIZE]
+        for attempt in range(ARM_MAX_ATTEMPTS):
+            if attempt:
+                time.sleep(_retry_delay(attempt - 1))
+            try:
+                responses = _run_batch(pending)
+            except (requests.RequestException, AzureError, ValueError) as e:
+                logging.error(f"Batch existence check failed for {len(pending)} snapshots: {str(e)}")
+                break
+            # Throttled or transient sub-requests are sent again in the next round
+            retry = []
+            for item in responses:
+                snapshot_id = pending[int(item["name"])]
+                status_code = item.get("httpStatusCode")
+                if status_code in ARM_RETRY_STATUSES:
+                    retry.append(snapshot_id)
+                elif status_code in (200, 404):
+                    exists_map[snapshot_id] = status_code == 200
                 else:
-                    logging.error(f"Failed to remove lock '{lock['name']}' from resource group '{resource_group}': {result}")
-    return removed_locks
+                    logging.error(f"Existence check for {snapshot_id} returned HTTP {status_code}")
+            pending = retry
+            if not pending:
+                break
+    return exists_map
 
-def check_snapshot_exists(snapshot_id):
-    command = f"az snapshot show --ids {snapshot_id}"
-    result = run_az_command(command)
-    return not result.startswith("Error:")
+async def begin_snapshot_delete(client, semaphore, resource_group, snapshot_name):
+    # Only the delete request itself counts against the write budget
+    async with semaphore:
+        try:
+            return await client.snapshots.begin_delete(resource_group, snapshot_name)
+        except AzureError as e:
+            logging.error(f"Error deleting snapshot '{snapshot_name}' in resource group '{resource_group}': {str(e)}")
+            return None
 
-def process_snapshot(snapshot_id, subscription_names):
+async def wait_for_snapshot_delete(poller, resource_group, snapshot_name):
+    if poller is None:
+        return False
     try:
-        parts = snapshot_id.split('/')
-        if len(parts) < 9:
-            logging.error(f"Invalid snapshot ID format: {snapshot_id}")
-            return None, "invalid", (snapshot_id, "Invalid snapshot ID format")
+        await poller.result()
+        return True
+    except AzureError as e:
+        logging.error(f"Error deleting snapshot '{snapshot_name}' in resource group '{resource_group}': {str(e)}")
+        return False
 
-        subscription_id = parts[2]
-        subscription_name = subscription_names.get(subscription_id, subscription_id)
-        snapshot_name = parts[-1]
+def new_results():
+    # results[subscription_name][status] -> list, created on first use
+    return defaultdict(lambda: defaultdict(list))
 
-        # Check if snapshot exists
-        if not check_snapshot_exists(snapshot_id):
-            return subscription_name, "non-existent", snapshot_name
+def pre_validate_snapshots(parsed, by_sub, invalid_ids, subscription_names, exists_map):
+    valid_by_sub = {}
+    results = new_results()
+    for subscription_id, indices in by_sub.items():
+        # One name lookup per subscription rather than per snapshot
+        subscription_results = results[subscription_names.get(subscription_id, subscription_id)]
+        valid_indices = []
+        for i in indices:
+            # Existence was checked up front in check_snapshots_exist
+            exists = exists_map.get(parsed.full[i])
+            if exists is None:
+                # Never assume a snapshot we could not check is gone
+                subscription_results["error"].append((parsed.name[i], "Existence check failed"))
+            elif exists:
+                subscription_results["valid"].append(parsed.name[i])
+                valid_indices.append(i)
+            else:
+                subscription_results["non-existent"].append(parsed.name[i])
+        if valid_indices:
+            valid_by_sub[subscription_id] = valid_indices
+    if invalid_ids:
+        results["Unknown"]["invalid"] = [(snapshot_id, "Invalid snapshot ID format") for snapshot_id in invalid_ids]
+    return valid_by_sub, results
 
-        return subscription_name, "valid", snapshot_name
-    except Exception as e:
-        logging.error(f"Error processing snapshot {snapshot_id}: {str(e)}")
-        return None, "error", (snapshot_id, str(e))
+async def delete_subscription_snapshots(client, parsed, indices):
+    # ARM throttles per subscription, so each subscription gets its own concurrency budget
+    semaphore = asyncio.Semaphore(MAX_DELETES_PER_SUBSCRIPTION)
+    # Submit every deletion first, then wait on all the long-running operations together
+    pollers = await asyncio.gather(*(
+        begin_snapshot_delete(client, semaphore, parsed.rg[i], parsed.name[i]) for i in indices
+    ))
+    return await asyncio.gather(*(
+        wait_for_snapshot_delete(poller, parsed.rg[i], parsed.name[i]) for poller, i in zip(pollers, indices)
+    ))
 
-def delete_snapshot(snapshot_id):
-    command = f"az snapshot delete --ids {snapshot_id}"
-    result = run_az_command(command)
-    return not result.startswith("Error:")
+async def delete_valid_snapshots(parsed, valid_by_sub, subscription_names):
+    results = new_results()
+    subscription_ids = list(valid_by_sub)
 
-def pre_validate_snapshots(snapshot_ids, subscription_names):
-    valid_snapshots = []
-    results = {}
-    for snapshot_id in snapshot_ids:
-        subscription_name, status, data = process_snapshot(snapshot_id, subscription_names)
-        if subscription_name:
-            if subscription_name not in results:
-                results[subscription_name] = {}
-            if status not in results[subscription_name]:
-                results[subscription_name][status] = []
-            results[subscription_name][status].append(data)
-            if status == "valid":
-                valid_snapshots.append(snapshot_id)
-        else:
-            if "Unknown" not in results:
-                results["Unknown"] = {}
-            if status not in results["Unknown"]:
-                results["Unknown"][status] = []
-            results["Unknown"][status].append(data)
-    return valid_snapshots, results
-
-def delete_valid_snapshots(valid_snapshots, subscription_names):
-    results = {}
-    for snapshot_id in valid_snapshots:
-        parts = snapshot_id.split('/')
-        subscription_id = parts[2]
+    # One client per subscription, all sharing a single aiohttp session and credential
+    async with aiohttp.ClientSession() as session, AsyncDefaultAzureCredential() as credential:
+        transport = AioHttpTransport(session=session, session_owner=False)
+        clients = {
+            subscription_id: ComputeManagementClient(
+                credential, subscription_id, transport=transport,
+                retry_total=DELETE_RETRY_TOTAL, retry_backoff_factor=DELETE_RETRY_BACKOFF,
+            )
+            for subscription_id in subscription_ids
+        }
+        try:
+            outcomes_per_subscription = await asyncio.gather(*(
+                delete_subscription_snapshots(clients[subscription_id], parsed, valid_by_sub[subscription_id])
+                for subscription_id in subscription_ids
+            ))
+        finally:
+            for client in clients.values():
+                await client.close()
+
+    for subscription_id, outcomes in zip(subscription_ids, outcomes_per_subscription):
         subscription_name = subscription_names.get(subscription_id, subscription_id)
-        snapshot_name = parts[-1]
-        success = delete_snapshot(snapshot_id)
-        if subscription_name not in results:
-            results[subscription_name] = {}
-        if success:
-            if "deleted" not in results[subscription_name]:
-                results[subscription_name]["deleted"] = []
-            results[subscription_name]["deleted"].append(snapshot_name)
-            logging.info(f"Deleted snapshot '{snapshot_name}' in subscription '{subscription_name}'")
-        else:
-            if "failed" not in results[subscription_name]:
-                results[subscription_name]["failed"] = []
-            results[subscription_name]["failed"].append((snapshot_name, "Deletion failed"))
-            logging.error(f"Failed to delete snapshot '{snapshot_name}' in subscription '{subscription_name}'")
+        subscription_results = results[subscription_name]
+        for i, success in zip(valid_by_sub[subscription_id], outcomes):
+            snapshot_name = parsed.name[i]
+            if success:
+                subscription_results["deleted"].append(snapshot_name)
+                logging.info(f"Deleted snapshot '{snapshot_name}' in subscription '{subscription_name}'")
+            else:
+                subscription_results["failed"].append((snapshot_name, "Deletion failed"))
+                logging.error(f"Failed to delete snapshot '{snapshot_name}' in subscription '{subscription_name}'")
     return results
 
-def restore_scope_locks(removed_locks):
-    current_subscription = None
-    restored_locks = []
-    for subscription_id, resource_group, lock_name in removed_locks:
-        current_subscription = switch_subscription(subscription_id, current_subscription)
-        command = f"az lock create --name {lock_name} --resource-group {resource_group} --lock-type CanNotDelete"
-        result = run_az_command(command)
-        if not result.startswith("Error:"):
-            restored_locks.append((subscription_id, resource_group, lock_name))
-            logging.info(f"Restored lock '{lock_name}' to resource group '{resource_group}'")
-        else:
-            logging.error(f"Failed to restore lock '{lock_name}' to resource group '{resource_group}': {result}")
-    return restored_locks
+def restore_scope_lock(subscription_id, resource_group, lock_name):
+    try:
+        response = _arm_request("PUT", lock_url(subscription_id, resource_group, lock_name),
+                                json={"properties": {"level": "CanNotDelete"}})
+        response.raise_for_status()
+        logging.info(f"Restored lock '{lock_name}' to resource group '{resource_group}'")
+        return True
+    except (requests.RequestException, AzureError) as e:
+        logging.error(f"Failed to restore lock '{lock_name}' to resource group '{resource_group}': {str(e)}")
+        return False
+
+async def restore_scope_locks(removed_locks):
+    if not removed_locks:
+        return []
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(max_workers=MAX_LOCK_WORKERS) as executor:
+        restored = await asyncio.gather(*(loop.run_in_executor(executor, restore_scope_lock, *lock) for lock in removed_locks))
+    return [lock for lock, success in zip(removed_locks, restored) if success]
 
 def generate_log_file(results, total_runtime):
     user_id = os.getenv('USER', 'unknown')
-    current_time = datetime.now().strftime("%Y%m%d-%H%M%S")
-    logs_dir = "logs"
-    os.makedirs(logs_dir, exist_ok=True)
-    log_filename = os.path.join(logs_dir, f"snapshot_deletion_log_{user_id}_{current_time}.txt")
+    current_time = time.strftime("%Y%m%d-%H%M%S")
+    log_filename = str(LOGS_DIR / f"snapshot_deletion_log_{user_id}_{current_time}.txt")
+    # Build the whole report first and write it out in one go
+    parts = [
+        "Snapshot Deletion Log\n",
+        "=====================\n\n",
+        f"User: {user_id}\n",
+        f"Date and Time: {current_time}\n\n",
+        "Summary:\n",
+    ]
+    parts.extend(
+        f"\nSubscription: {subscription_name}\n"
+        f"  Valid Snapshots: {len(data.get('valid', []))}\n"
+        f"  Non-existent Snapshots: {len(data.get('non-existent', []))}\n"
+        f"  Deleted Snapshots: {len(data.get('deleted', []))}\n"
+        f"  Failed Deletions: {len(data.get('failed', []))}\n"
+        f"  Existence Check Errors: {len(data.get('error', []))}\n"
+        for subscription_name, data in results.items()
+    )
+    parts.append(f"\nTotal Runtime: {total_runtime:.2f} seconds\n")
     try:
-        with open(log_filename, 'w') as log_file:
-            log_file.write("Snapshot Deletion Log\n")
-            log_file.write("=====================\n\n")
-            log_file.write(f"User: {user_id}\n")
-            log_file.write(f"Date and Time: {current_time}\n\n")
-            log_file.write("Summary:\n")
-            for subscription_name, data in results.items():
-                log_file.write(f"\nSubscription: {subscription_name}\n")
-                log_file.write(f"  Valid Snapshots: {len(data.get('valid', []))}\n")
-                log_file.write(f"  Non-existent Snapshots: {len(data.get('non-existent', []))}\n")
-                log_file.write(f"  Deleted Snapshots: {len(data.get('deleted', []))}\n")
-                log_file.write(f"  Failed Deletions: {len(data.get('failed', []))}\n")
-            log_file.write(f"\nTotal Runtime: {total_runtime:.2f} seconds\n")
+        with open(log_filename, 'w', buffering=1 << 20) as log_file:
+            log_file.write("".join(parts))
     except Exception as e:
         logging.error(f"Failed to write log file: {str(e)}")
         return None
     return log_filename
 
-def main(snapshot_ids: List[str]) -> Dict[str, Any]:
+def generate_records_file(results, log_filename):
+    # One JSON object per snapshot next to the text summary, for jq and other tooling
+    records_filename = os.path.splitext(log_filename)[0] + ".ndjson"
+    lines = [
+        json_dumps({"subscription": subscription_name, "status": status, "item": item}) + "\n"
+        for subscription_name, data in results.items()
+        for status, items in data.items()
+        for item in items
+    ]
+    try:
+        with open(records_filename, 'w', buffering=1 << 20) as records_file:
+            records_file.write("".join(lines))
+    except Exception as e:
+        logging.error(f"Failed to write records file: {str(e)}")
+        return None
+    return records_filename
+
+async def main_async(snapshot_ids: List[str], skip_locks: bool = False) -> Dict[str, Any]:
     try:
-        if not check_az_login():
+        loop = asyncio.get_running_loop()
+        # Acquiring the ARM token doubles as the login check
+        if not await loop.run_in_executor(None, check_az_login):
             return {"error": "Not logged in to Azure. Please run 'az login'."}
 
+        # Duplicate IDs would mean duplicate ARM calls and two deletions racing on one snapshot
+        unique_ids = list(dict.fromkeys(snapshot_ids))
+        if len(unique_ids) < len(snapshot_ids):
+            logging.info(f"Dropped {len(snapshot_ids) - len(unique_ids)} duplicate snapshot IDs")
+        snapshot_ids = unique_ids
+
         start_time = time.time()
 
-        subscription_names = get_subscription_names()
+        # Subscription names and existence checks are independent REST calls; run them side by side
+        parsed, invalid_ids = parse_snapshot_ids(snapshot_ids)
+        subscription_names, exists_map = await asyncio.gather(
+            loop.run_in_executor(None, get_subscription_names),
+            loop.run_in_executor(None, check_snapshots_exist, parsed.full),
+        )
         if not subscription_names:
             logging.warning("Failed to fetch subscription names. Using IDs instead.")
 
-        valid_snapshots, pre_validation_results = pre_validate_snapshots(snapshot_ids, subscription_names)
+        by_sub = group_by_subscription(parsed)
+        valid_by_sub, pre_validation_results = pre_validate_snapshots(parsed, by_sub, invalid_ids, subscription_names, exists_map)
 
-        if not valid_snapshots:
+        if not valid_by_sub:
             results = pre_validation_results
         else:
-            resource_groups = get_resource_groups_from_snapshots(valid_snapshots)
-            removed_locks = check_and_remove_scope_locks(resource_groups)
-            deletion_results = delete_valid_snapshots(valid_snapshots, subscription_names)
-            restored_locks = restore_scope_locks(removed_locks)
+            resource_groups = get_resource_groups_from_snapshots(parsed, valid_by_sub)
+            # With --skip-locks the caller knows the resource groups are not locked
+            removed_locks = []
+            try:
+                if not skip_locks:
+                    removed_locks = await check_and_remove_scope_locks(resource_groups)
+                deletion_results = await delete_valid_snapshots(parsed, valid_by_sub, subscription_names)
+            finally:
+                # Locks go back on even if deletion blows up half way through
+                restored_locks = await restore_scope_locks(removed_locks)
 
             # Merge pre-validation results with deletion results
             results = pre_validation_results
             for subscription, data in deletion_results.items():
-                if subscription in results:
-                    results[subscription].update(data)
-                else:
-                    results[subscription] = data
+                results[subscription].update(data)
+
+        # Plain dicts from here on, so lookups of missing keys no longer create them
+        results = {subscription: dict(data) for subscription, data in results.items()}
 
         end_time = time.time()
         total_runtime = end_time - start_time
 
         log_filename = generate_log_file(results, total_runtime)
+        records_filename = generate_records_file(results, log_filename) if log_filename else None
 
         return {
             "results": results,
             "log_file": log_filename,
+            "records_file": records_filename,
             "total_runtime": total_runtime
         }
 
     except Exception as e:
+        # Only needed on this failure path, so it is not imported at startup
+        import traceback
         logging.error(f"An unexpected error occurred: {str(e)}\n{traceback.format_exc()}")
         return {"error": str(e)}
 
+def main(snapshot_ids: List[str], skip_locks: bool = False) -> Dict[str, Any]:
+    return asyncio.run(main_async(snapshot_ids, skip_locks))
+
 if __name__ == "__main__":
-    import sys
-    import json
+    args = sys.argv[1:]
+    skip_locks = "--skip-locks" in args
+    args = [arg for arg in args if arg != "--skip-locks"]
 
     # Read snapshot IDs from command line arguments or stdin
-    if len(sys.argv) > 1:
+    if args:
         # Assume snapshot IDs are passed as command line arguments
-        snapshot_ids = sys.argv[1:]
+        snapshot_ids = args
     else:
-        # Read snapshot IDs from stdin
-        input_data = sys.stdin.read()
-        snapshot_ids = json.loads(input_data)
+        # Read snapshot IDs from stdin as raw bytes; both orjson and json parse them without a decode pass
+        input_data = sys.stdin.buffer.read()
+        snapshot_ids = json_loads(input_data)
 
-    result = main(snapshot_ids)
-    print(json.dumps(result))
\ No newline at end of file
+    result = main(snapshot_ids, skip_locks)
+    print(json_dumps(result))
\ No newline at end of file
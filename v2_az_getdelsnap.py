@@ -1,12 +1,17 @@
 import asyncio
+import atexit
 import json
 import logging
+import queue
+import re
+from logging.handlers import MemoryHandler, QueueHandler, QueueListener
 from datetime import datetime, timezone, timedelta
 import getpass
 import time
 import csv
 import os
 from typing import List, Dict, Any
+from urllib.parse import quote
 from rich.console import Console
 from rich.prompt import Prompt
 from rich.progress import Progress, SpinnerColumn, BarColumn, TextColumn, TimeRemainingColumn
@@ -14,23 +19,69 @@ from rich.table import Table
 from rich.live import Live
 from rich.panel import Panel
 from rich.console import Group
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+import aiohttp
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 console = Console()
 COLOR_SCALE = ["green", "yellow", "red"]
+_SNAP_COLS = [
+    ("Name", "cyan"),
+    ("Resource Group", "magenta"),
+    ("Time Created", "green"),
+    ("Age (days)", "yellow"),
+    ("Created By", "blue"),
+    ("Status", "red"),
+]
+
+# Snapshot existence checks and deletions talk to ARM directly over one keep-alive session
+ARM_ENDPOINT = "https://management.azure.com"
+SNAPSHOT_API_VERSION = "2022-07-02"
+LOCK_API_VERSION = "2016-09-01"
+# Upper bound on ARM calls in flight at once, to stay clear of throttling
+MAX_CONCURRENT_REQUESTS = 20
+# Upper bound on subscriptions scanned at once
+MAX_CONCURRENT_SCANS = 10
+# Throttled and transient failures are retried with exponential backoff (1s, 2s, 4s, ... capped)
+MAX_RETRIES = 3
+RETRY_BASE_DELAY = 1
+RETRY_MAX_DELAY = 30
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+THROTTLE_MARKERS = ("rate limit", "quota", "429", "throttl", "toomanyrequests", "operationnotallowed")
+_http_session = None
+_arm_token = None
+_token_lock = None
+_semaphore = None
+# Subscriptions don't change within a run; 'az account list' is only called once
+_subscriptions_cache = None
+# Keywords that can go into a JMESPath raw string as-is: no letters, so case can't matter, and no
+# quote or backslash that could end the string early
+PUSHDOWN_KEYWORD_RE = re.compile(r"[0-9._-]+")
 
 # Configure logging
 current_date = datetime.now().strftime("%Y%m%d")
 current_user = getpass.getuser()
 log_file = f'azure_snapshot_manager_{current_date}_{current_user}.log'
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(log_file),
-        logging.StreamHandler()
-    ]
-)
+# Records are only enqueued on the hot path; a listener thread formats them and writes the file in
+# buffered batches, so concurrent tasks never wait on the file handler's lock
+log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler = logging.FileHandler(log_file)
+file_handler.setFormatter(log_formatter)
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(log_formatter)
+log_queue = queue.SimpleQueue()
+log_listener = QueueListener(log_queue, MemoryHandler(100, flushLevel=logging.ERROR, target=file_handler), stream_handler)
+log_listener.start()
+# Runs before logging's own shutdown hook, which then flushes the buffered file records
+atexit.register(log_listener.stop)
+# The queue side only renders the message; the listener's handlers add the timestamp and level
+queue_handler = QueueHandler(log_queue)
+queue_handler.setFormatter(logging.Formatter('%(message)s'))
+logging.basicConfig(level=logging.DEBUG, handlers=[queue_handler])
 logger = logging.getLogger(__name__)
 logger.info(f"Logging to file: {log_file}")
 
@@ -47,40 +98,180 @@ overall_progress = Progress(
 )
 overall_task = overall_progress.add_task(description="[cyan]Processing...", total=100, subscription="")
 
+def retry_delay(attempt, retry_after=None):
+    # Azure's Retry-After wins when present; otherwise back off exponentially
+    if retry_after and retry_after.isdigit():
+        return int(retry_after)
+    return min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)
+
+def poll_delay(headers, default):
+    # Retry-After may also be an HTTP-date; anything but whole seconds keeps the current delay
+    retry_after = headers.get("Retry-After", "")
+    return int(retry_after) if retry_after.isdigit() else default
+
+def is_throttled(error_message):
+    error_message = error_message.lower()
+    return any(marker in error_message for marker in THROTTLE_MARKERS)
+
 async def run_az_command(command):
-    logger.info(f"Running Azure command: {command}")
+    # Commands are argv lists executed directly: no /bin/sh in between and no quoting pitfalls
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(f"Running Azure command: {' '.join(command)}")
     try:
-        if isinstance(command, list):
+        for attempt in range(MAX_RETRIES + 1):
             process = await asyncio.create_subprocess_exec(
                 *command,
                 stdout=asyncio.subprocess.PIPE,
                 stderr=asyncio.subprocess.PIPE
             )
-        else:
-            process = await asyncio.create_subprocess_shell(
-                command,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-        stdout, stderr = await process.communicate()
-        if process.returncode == 0:
-            logger.info("Command executed successfully")
-            return stdout.decode().strip()
-        else:
+            stdout, stderr = await process.communicate()
+            if process.returncode == 0:
+                logger.info("Command executed successfully")
+                return stdout.decode().strip()
             error_message = stderr.decode().strip()
-            logger.error(f"Error running command: {command}")
+            if attempt < MAX_RETRIES and is_throttled(error_message):
+                delay = retry_delay(attempt)
+                logger.warning(f"Azure throttled command, retrying in {delay}s: {' '.join(command)}")
+                await asyncio.sleep(delay)
+                continue
+            logger.error(f"Error running command: {' '.join(command)}")
             logger.error(f"Error message: {error_message}")
-            console.print(f"[red]Error running command: {command}[/red]")
+            console.print(f"[red]Error running command: {' '.join(command)}[/red]")
             console.print(f"[red]Error message: {error_message}[/red]")
             return None
     except Exception as e:
-        logger.exception(f"An error occurred while running command: {command}")
+        logger.exception(f"An error occurred while running command: {' '.join(command)}")
         console.print(f"[bold red]An error occurred: {str(e)}[/bold red]")
         return None
 
+async def get_arm_token(rejected=None):
+    # One az call per run; the token is reused until ARM rejects it. Concurrent callers queue on the
+    # lock and pick up the token the first of them fetched instead of each spawning their own az
+    global _arm_token, _token_lock
+    if _arm_token is not None and _arm_token != rejected:
+        return _arm_token
+    if _token_lock is None:
+        _token_lock = asyncio.Lock()
+    async with _token_lock:
+        if _arm_token is None or _arm_token == rejected:
+            token = await run_az_command(["az", "account", "get-access-token", "--query", "accessToken", "-o", "tsv"])
+            if not token:
+                raise RuntimeError("Failed to get an Azure access token")
+            _arm_token = token
+    return _arm_token
+
+def get_http_session():
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=64))
+    return _http_session
+
+def get_semaphore():
+    # Created on first use so it belongs to the running event loop
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    return _semaphore
+
+async def close_http_session():
+    # The semaphore and token lock belong to this run's event loop, so they go with the session;
+    # a later delete_snapshots() under a new asyncio.run() creates fresh ones
+    global _http_session, _semaphore, _token_lock
+    if _http_session is not None:
+        await _http_session.close()
+        _http_session = None
+    _semaphore = None
+    _token_lock = None
+
+async def arm_request(method, url, payload=None):
+    if url.startswith('/'):
+        url = ARM_ENDPOINT + url
+    session = get_http_session()
+    rejected_token = None
+    refreshed = False
+    retries = 0
+    while True:
+        token = await get_arm_token(rejected=rejected_token)
+        headers = {"Authorization": f"Bearer {token}"}
+        async with session.request(method, url, headers=headers, json=payload) as response:
+            body = await response.read()
+            status, response_headers = response.status, response.headers
+        # An expired token is refreshed once before giving up
+        if status == 401 and not refreshed:
+            rejected_token = token
+            refreshed = True
+            continue
+        if status in RETRYABLE_STATUSES and retries < MAX_RETRIES:
+            delay = retry_delay(retries, response_headers.get("Retry-After"))
+            logger.warning(f"{method} {url} returned HTTP {status}, retrying in {delay}s")
+            await asyncio.sleep(delay)
+            retries += 1
+            continue
+        return status, response_headers, body
+
+async def wait_for_operation(headers):
+    async_operation_url = headers.get("Azure-AsyncOperation")
+    location_url = headers.get("Location")
+    delay = poll_delay(headers, 5)
+    while async_operation_url or location_url:
+        await asyncio.sleep(delay)
+        if async_operation_url:
+            status, headers, body = await arm_request("GET", async_operation_url)
+            if status != 200:
+                return False
+            operation_status = json.loads(body).get("status")
+            if operation_status == "Succeeded":
+                return True
+            if operation_status in ("Failed", "Canceled"):
+                return False
+        else:
+            status, headers, _ = await arm_request("GET", location_url)
+            if status != 202:
+                return status in (200, 204)
+        delay = poll_delay(headers, delay)
+    return True
+
+async def stream_az_json_items(command, keep=None):
+    # Parses the top-level JSON array from az's stdout as it arrives, so only the kept items are held in memory
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(f"Running Azure command: {' '.join(command)}")
+    for attempt in range(MAX_RETRIES + 1):
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        # Drain stderr alongside stdout so a chatty az can't block on a full pipe
+        stderr_task = asyncio.create_task(process.stderr.read())
+        items = []
+        parse_error = None
+        try:
+            async for item in ijson.items(process.stdout, 'item', use_float=True):
+                if keep is None or keep(item):
+                    items.append(item)
+        except ijson.JSONError as e:
+            # Failed commands print nothing (or not JSON) on stdout; the exit code tells the story.
+            # Whatever is left must still be drained, or az blocks on a full pipe and never exits
+            parse_error = e
+            await process.stdout.read()
+        error_message = (await stderr_task).decode().strip()
+        await process.wait()
+        if process.returncode == 0 and parse_error is not None:
+            # A clean exit with unparseable output would otherwise pass off a partial list as complete
+            return None, f"Failed to parse az output: {str(parse_error)}"
+        if process.returncode == 0:
+            logger.info("Command executed successfully")
+            return items, None
+        if attempt < MAX_RETRIES and is_throttled(error_message):
+            delay = retry_delay(attempt)
+            logger.warning(f"Azure throttled command, retrying in {delay}s: {' '.join(command)}")
+            await asyncio.sleep(delay)
+            continue
+        return None, error_message
+
 async def check_az_login():
     logger.info("Checking Azure login status")
-    result = await run_az_command("az account show")
+    result = await run_az_command(["az", "account", "show"])
     if result:
         logger.info("User is already logged in to Azure")
         return True
@@ -91,7 +282,7 @@ async def check_az_login():
 async def perform_az_login():
     logger.info("Initiating Azure login process")
     console.print("[yellow]You are not logged in to Azure. Initiating login process...[/yellow]")
-    result = await run_az_command("az login --scope https://management.core.windows.net//.default")
+    result = await run_az_command(["az", "login", "--scope", "https://management.core.windows.net//.default"])
     if result:
         logger.info("Azure login successful")
         console.print("[green]Azure login successful[/green]")
@@ -104,27 +295,50 @@ async def perform_az_login():
         return False
 
 async def get_subscriptions():
+    global _subscriptions_cache
+    if _subscriptions_cache is not None:
+        return _subscriptions_cache
     logger.info("Fetching Azure subscriptions")
-    result = await run_az_command("az account list --query '[].{name:name, id:id}' -o json")
+    result = await run_az_command(["az", "account", "list", "--query", "[].{name:name, id:id}", "-o", "json"])
     if result:
-        subscriptions = json.loads(result)
-        logger.info(f"Found {len(subscriptions)} subscriptions")
-        return subscriptions
+        _subscriptions_cache = json.loads(result)
+        logger.info(f"Found {len(_subscriptions_cache)} subscriptions")
+        return _subscriptions_cache
     logger.warning("No subscriptions found")
     return []
 
 async def get_snapshots(subscription_id, start_date, end_date, keyword=None):
     logger.info(f"Fetching snapshots for subscription {subscription_id} between {start_date} and {end_date}")
-    query = f"[?timeCreated >= '{start_date}' && timeCreated <= '{end_date}'].{{name:name, resourceGroup:resourceGroup, timeCreated:timeCreated, diskState:diskState, id:id, createdBy:tags.createdBy}}"
-    command = f"az snapshot list --subscription {subscription_id} --query \"{query}\" -o json"
+    keyword = keyword.lower() if keyword else None
+    keyword_filter = ""
+    # JMESPath has no lower-case function, so the match can only move into --query when case can't
+    # matter (e.g. a date stamp like '2024-05'); otherwise it stays a case-insensitive Python check
+    if keyword and PUSHDOWN_KEYWORD_RE.fullmatch(keyword):
+        keyword_filter = f" && contains(name, '{keyword}')"
+        keyword = None
+    query = f"[?timeCreated >= '{start_date}' && timeCreated <= '{end_date}'{keyword_filter}].{{name:name, resourceGroup:resourceGroup, timeCreated:timeCreated, diskState:diskState, id:id, createdBy:tags.createdBy}}"
+    command = ["az", "snapshot", "list", "--subscription", subscription_id, "--query", query, "-o", "json"]
+    if ijson is not None:
+        snapshots, error_message = await stream_az_json_items(
+            command, (lambda s: keyword in s['name'].lower()) if keyword else None
+        )
+        if snapshots is not None:
+            logger.info(f"Found {len(snapshots)} snapshots in subscription {subscription_id}")
+            return annotate_snapshots(snapshots, subscription_id)
+        if "AuthorizationFailed" in error_message:
+            logger.warning(f"No permission to list snapshots in subscription {subscription_id}. Skipping.")
+        else:
+            logger.error(f"Error listing snapshots for subscription {subscription_id}: {error_message}")
+        return []
+
     result = await run_az_command(command)
     if result:
         try:
             snapshots = json.loads(result)
             if keyword:
-                snapshots = [s for s in snapshots if keyword.lower() in s['name'].lower()]
+                snapshots = [s for s in snapshots if keyword in s['name'].lower()]
             logger.info(f"Found {len(snapshots)} snapshots in subscription {subscription_id}")
-            return snapshots
+            return annotate_snapshots(snapshots, subscription_id)
         except json.JSONDecodeError:
             if "AuthorizationFailed" in result:
                 logger.warning(f"No permission to list snapshots in subscription {subscription_id}. Skipping.")
@@ -134,8 +348,16 @@ async def get_snapshots(subscription_id, start_date, end_date, keyword=None):
     logger.warning(f"No snapshots found in subscription {subscription_id}")
     return []
 
-def get_age_color(created_date):
-    age = (datetime.now(timezone.utc) - datetime.fromisoformat(created_date)).days
+def annotate_snapshots(snapshots, subscription_id):
+    # Parse timestamps once at fetch time against a single 'now', and record the subscription
+    # the snapshot was listed from; later passes then never re-parse dates or split IDs
+    now = datetime.now(timezone.utc)
+    for snapshot in snapshots:
+        snapshot['_age_days'] = (now - datetime.fromisoformat(snapshot['timeCreated'])).days
+        snapshot['_sub_id'] = subscription_id
+    return snapshots
+
+def get_age_color(age):
     if age < 30:
         return COLOR_SCALE[0]
     elif age < 90:
@@ -145,17 +367,12 @@ def get_age_color(created_date):
 
 def create_snapshot_table(snapshots, subscription_name):
     table = Table(title=f"Snapshots in {subscription_name}")
-    table.add_column("Name", style="cyan")
-    table.add_column("Resource Group", style="magenta")
-    table.add_column("Time Created", style="green")
-    table.add_column("Age (days)", style="yellow")
-    table.add_column("Created By", style="blue")
-    table.add_column("Status", style="red")
+    for name, style in _SNAP_COLS:
+        table.add_column(name, style=style)
 
     for snapshot in snapshots:
-        created_date = datetime.fromisoformat(snapshot['timeCreated'])
-        age = (datetime.now(timezone.utc) - created_date).days
-        age_color = get_age_color(snapshot['timeCreated'])
+        age = snapshot['_age_days']
+        age_color = get_age_color(age)
         created_by = snapshot.get('createdBy', 'N/A')
         status = snapshot.get('diskState', 'N/A')
 
@@ -183,26 +400,33 @@ def get_default_date_range():
     end_of_month = (start_of_month + timedelta(days=32)).replace(day=1) - timedelta(seconds=1)
     return start_of_month.isoformat(), end_of_month.isoformat()
 
-async def delete_snapshots(snapshot_ids: List[str]) -> Dict[str, Any]:
+async def delete_snapshots(snapshot_ids: List[str], subscription_names: Dict[str, str] = None) -> Dict[str, Any]:
     try:
         if not await check_az_login():
             return {"error": "Not logged in to Azure. Please run 'az login'."}
 
         start_time = time.time()
 
-        subscription_names = {sub['id']: sub['name'] for sub in await get_subscriptions()}
+        if subscription_names is None:
+            subscription_names = {sub['id']: sub['name'] for sub in await get_subscriptions()}
         if not subscription_names:
             logger.warning("Failed to fetch subscription names. Using IDs instead.")
 
+        # Fetch the token before fanning out so the first wave of requests doesn't race for it
+        await get_arm_token()
         valid_snapshots, pre_validation_results = await pre_validate_snapshots(snapshot_ids, subscription_names)
 
         if not valid_snapshots:
             results = pre_validation_results
         else:
             resource_groups = get_resource_groups_from_snapshots(valid_snapshots)
-            removed_locks = await check_and_remove_scope_locks(resource_groups)
-            deletion_results = await delete_valid_snapshots(valid_snapshots, subscription_names)
-            restored_locks = await restore_scope_locks(removed_locks)
+            removed_locks = []
+            try:
+                removed_locks = await check_and_remove_scope_locks(resource_groups)
+                deletion_results = await delete_valid_snapshots(valid_snapshots, subscription_names)
+            finally:
+                # Locks go back on even if deletion blows up half way through
+                restored_locks = await restore_scope_locks(removed_locks)
 
             # Merge pre-validation results with deletion results
             results = pre_validation_results
@@ -225,14 +449,32 @@ async def delete_snapshots(snapshot_ids: List[str]) -> Dict[str, Any]:
     except Exception as e:
         logger.error(f"An unexpected error occurred: {str(e)}")
         return {"error": str(e)}
+    finally:
+        await close_http_session()
+
+SnapRef = namedtuple('SnapRef', 'sub_id rg name id')
+
+def parse_snapshot_id(snapshot_id):
+    parts = snapshot_id.split('/')
+    if len(parts) < 9:
+        return None
+    return SnapRef(parts[2], parts[4], parts[-1], snapshot_id)
 
 async def pre_validate_snapshots(snapshot_ids, subscription_names):
     valid_snapshots = []
     results = {}
+    semaphore = get_semaphore()
+
+    async def validate(snapshot_id):
+        ref = parse_snapshot_id(snapshot_id)
+        async with semaphore:
+            return ref, await process_snapshot(snapshot_id, ref, subscription_names)
+
     with Progress(console=console) as progress:
         task = progress.add_task("[cyan]Validating snapshots...", total=len(snapshot_ids))
-        for snapshot_id in snapshot_ids:
-            subscription_name, status, data = await process_snapshot(snapshot_id, subscription_names)
+        tasks = [asyncio.create_task(validate(snapshot_id)) for snapshot_id in snapshot_ids]
+        for next_done in asyncio.as_completed(tasks):
+            ref, (subscription_name, status, data) = await next_done
             if subscription_name:
                 if subscription_name not in results:
                     results[subscription_name] = {}
@@ -240,7 +482,7 @@ async def pre_validate_snapshots(snapshot_ids, subscription_names):
                     results[subscription_name][status] = []
                 results[subscription_name][status].append(data)
                 if status == "valid":
-                    valid_snapshots.append(snapshot_id)
+                    valid_snapshots.append(ref)
             else:
                 if "Unknown" not in results:
                     results["Unknown"] = {}
@@ -250,81 +492,128 @@ async def pre_validate_snapshots(snapshot_ids, subscription_names):
             progress.update(task, advance=1)
     return valid_snapshots, results
 
-async def process_snapshot(snapshot_id, subscription_names):
+async def process_snapshot(snapshot_id, ref, subscription_names):
     try:
-        parts = snapshot_id.split('/')
-        if len(parts) < 9:
+        if ref is None:
             logger.error(f"Invalid snapshot ID format: {snapshot_id}")
             return None, "invalid", (snapshot_id, "Invalid snapshot ID format")
 
-        subscription_id = parts[2]
-        subscription_name = subscription_names.get(subscription_id, subscription_id)
-        snapshot_name = parts[-1]
+        subscription_name = subscription_names.get(ref.sub_id, ref.sub_id)
 
         # Check if snapshot exists
-        if not await check_snapshot_exists(snapshot_id):
-            return subscription_name, "non-existent", snapshot_name
+        if not await check_snapshot_exists(ref.id):
+            return subscription_name, "non-existent", ref.name
 
-        return subscription_name, "valid", snapshot_name
+        return subscription_name, "valid", ref.name
     except Exception as e:
         logger.error(f"Error processing snapshot {snapshot_id}: {str(e)}")
         return None, "error", (snapshot_id, str(e))
 
 async def check_snapshot_exists(snapshot_id):
-    command = f"az snapshot show --ids {snapshot_id}"
-    result = await run_az_command(command)
-    return result is not None and not result.startswith("Error:")
+    try:
+        status, _, _ = await arm_request("GET", f"{snapshot_id}?api-version={SNAPSHOT_API_VERSION}")
+        return status == 200
+    except aiohttp.ClientError as e:
+        logger.error(f"Error checking snapshot {snapshot_id}: {str(e)}")
+        return False
+
+def get_resource_groups_from_snapshots(refs):
+    return {(ref.sub_id, ref.rg) for ref in refs}  # (subscription_id, resource_group)
+
+async def list_subscription_locks(subscription_id):
+    locks = []
+    url = f"/subscriptions/{subscription_id}/providers/Microsoft.Authorization/locks?api-version={LOCK_API_VERSION}"
+    try:
+        while url:
+            status, _, body = await arm_request("GET", url)
+            if status != 200:
+                logger.error(f"Failed to list locks for subscription {subscription_id}: HTTP {status} {body.decode(errors='replace')}")
+                break
+            page = json.loads(body)
+            locks.extend(page.get("value", []))
+            url = page.get("nextLink")
+    except aiohttp.ClientError as e:
+        logger.error(f"Failed to list locks for subscription {subscription_id}: {str(e)}")
+    return locks
+
+def lock_url(subscription_id, resource_group, lock_name):
+    # The subscription is part of the URL, so lock calls never depend on 'az account set'
+    return (f"/subscriptions/{subscription_id}/resourceGroups/{resource_group}"
+            f"/providers/Microsoft.Authorization/locks/{quote(lock_name, safe='')}?api-version={LOCK_API_VERSION}")
+
+async def remove_scope_lock(subscription_id, resource_group, lock_name):
+    try:
+        status, _, body = await arm_request("DELETE", lock_url(subscription_id, resource_group, lock_name))
+    except Exception as e:
+        # Never raise: a failed removal must not stop the locks already removed from being restored
+        return str(e)
+    return None if status in (200, 204) else f"HTTP {status} {body.decode(errors='replace')}"
 
-def get_resource_groups_from_snapshots(snapshot_ids):
-    resource_groups = set()
-    for snapshot_id in snapshot_ids:
-        parts = snapshot_id.split('/')
-        if len(parts) >= 5:
-            resource_groups.add((parts[2], parts[4]))  # (subscription_id, resource_group)
-    return resource_groups
+async def restore_scope_lock(subscription_id, resource_group, lock_name):
+    try:
+        status, _, body = await arm_request("PUT", lock_url(subscription_id, resource_group, lock_name),
+                                            payload={"properties": {"level": "CanNotDelete"}})
+    except Exception as e:
+        # Never raise: one failed restore must not abandon the other restores still in flight
+        return str(e)
+    return None if status in (200, 201) else f"HTTP {status} {body.decode(errors='replace')}"
 
 async def check_and_remove_scope_locks(resource_groups):
     removed_locks = []
-    current_subscription = None
+    semaphore = get_semaphore()
+    groups_by_subscription = defaultdict(set)
+    for subscription_id, resource_group in resource_groups:
+        groups_by_subscription[subscription_id].add(resource_group.lower())
+
+    async def list_locks(subscription_id):
+        async with semaphore:
+            return subscription_id, await list_subscription_locks(subscription_id)
+
+    async def remove(lock):
+        async with semaphore:
+            return lock, await remove_scope_lock(*lock)
+
     with Progress(console=console) as progress:
-        task = progress.add_task("[cyan]Checking and removing scope locks...", total=len(resource_groups))
-        for subscription_id, resource_group in resource_groups:
-            current_subscription = await switch_subscription(subscription_id, current_subscription)
-            command = f"az lock list --resource-group {resource_group} --query '[].{{name:name, level:level}}' -o json"
-            locks = json.loads(await run_az_command(command))
-            for lock in locks:
-                if lock['level'] == 'CanNotDelete':
-                    remove_command = f"az lock delete --name {lock['name']} --resource-group {resource_group}"
-                    result = await run_az_command(remove_command)
-                    if result is not None and not result.startswith("Error:"):
-                        removed_locks.append((subscription_id, resource_group, lock['name']))
-                        logger.info(f"Removed lock '{lock['name']}' from resource group '{resource_group}'")
-                    else:
-                        logger.error(f"Failed to remove lock '{lock['name']}' from resource group '{resource_group}': {result}")
+        task = progress.add_task("[cyan]Checking and removing scope locks...", total=len(groups_by_subscription))
+        # One lock listing per subscription (the subscription is in the URL, no 'az account set'),
+        # filtered locally to CanNotDelete locks on the affected resource groups
+        locks = []
+        tasks = [asyncio.create_task(list_locks(subscription_id)) for subscription_id in groups_by_subscription]
+        for next_done in asyncio.as_completed(tasks):
+            subscription_id, subscription_locks = await next_done
+            for lock in subscription_locks:
+                # Resource group scope: /subscriptions/{sub}/resourceGroups/{rg}/providers/Microsoft.Authorization/locks/{name}
+                parts = lock['id'].split('/')
+                if (len(parts) == 9 and parts[3].lower() == 'resourcegroups'
+                        and parts[4].lower() in groups_by_subscription[subscription_id]
+                        and lock['properties']['level'] == 'CanNotDelete'):
+                    locks.append((subscription_id, parts[4], lock['name']))
             progress.update(task, advance=1)
-    return removed_locks
 
-async def switch_subscription(subscription, current_subscription):
-    if subscription != current_subscription:
-        try:
-            await run_az_command(['az', 'account', 'set', '--subscription', subscription])
-            logger.info(f"Switched to subscription: {subscription}")
-            return subscription
-        except Exception as e:
-            logger.error(f"Failed to switch to subscription {subscription}: {str(e)}")
-            raise
-    return current_subscription
+        for (subscription_id, resource_group, lock_name), error in await asyncio.gather(*(remove(lock) for lock in locks)):
+            if error is None:
+                removed_locks.append((subscription_id, resource_group, lock_name))
+                logger.info(f"Removed lock '{lock_name}' from resource group '{resource_group}'")
+            else:
+                logger.error(f"Failed to remove lock '{lock_name}' from resource group '{resource_group}': {error}")
+    return removed_locks
 
 async def delete_valid_snapshots(valid_snapshots, subscription_names):
     results = {}
+    semaphore = get_semaphore()
+
+    # ARM has no multi-snapshot DELETE, so each snapshot is its own task and reports as soon as it finishes
+    async def delete(ref):
+        async with semaphore:
+            return ref, await delete_snapshot(ref.id)
+
     with Progress(console=console) as progress:
         task = progress.add_task("[cyan]Deleting snapshots...", total=len(valid_snapshots))
-        for snapshot_id in valid_snapshots:
-            parts = snapshot_id.split('/')
-            subscription_id = parts[2]
-            subscription_name = subscription_names.get(subscription_id, subscription_id)
-            snapshot_name = parts[-1]
-            success = await delete_snapshot(snapshot_id)
+        tasks = [asyncio.create_task(delete(ref)) for ref in valid_snapshots]
+        for next_done in asyncio.as_completed(tasks):
+            ref, success = await next_done
+            subscription_name = subscription_names.get(ref.sub_id, ref.sub_id)
+            snapshot_name = ref.name
             if subscription_name not in results:
                 results[subscription_name] = {}
             if success:
@@ -341,24 +630,36 @@ async def delete_valid_snapshots(valid_snapshots, subscription_names):
     return results
 
 async def delete_snapshot(snapshot_id):
-    command = f"az snapshot delete --ids {snapshot_id}"
-    result = await run_az_command(command)
-    return result is not None and not result.startswith("Error:")
+    try:
+        status, headers, body = await arm_request("DELETE", f"{snapshot_id}?api-version={SNAPSHOT_API_VERSION}")
+        if status == 202:
+            return await wait_for_operation(headers)
+        if status in (200, 204):
+            return True
+        logger.error(f"Error deleting snapshot {snapshot_id}: HTTP {status} {body.decode(errors='replace')}")
+        return False
+    except Exception as e:
+        logger.error(f"Error deleting snapshot {snapshot_id}: {str(e)}")
+        return False
 
 async def restore_scope_locks(removed_locks):
-    current_subscription = None
     restored_locks = []
+    semaphore = get_semaphore()
+
+    async def restore(lock):
+        async with semaphore:
+            return lock, await restore_scope_lock(*lock)
+
     with Progress(console=console) as progress:
         task = progress.add_task("[cyan]Restoring scope locks...", total=len(removed_locks))
-        for subscription_id, resource_group, lock_name in removed_locks:
-            current_subscription = await switch_subscription(subscription_id, current_subscription)
-            command = f"az lock create --name {lock_name} --resource-group {resource_group} --lock-type CanNotDelete"
-            result = await run_az_command(command)
-            if result is not None and not result.startswith("Error:"):
+        tasks = [asyncio.create_task(restore(lock)) for lock in removed_locks]
+        for next_done in asyncio.as_completed(tasks):
+            (subscription_id, resource_group, lock_name), error = await next_done
+            if error is None:
                 restored_locks.append((subscription_id, resource_group, lock_name))
                 logger.info(f"Restored lock '{lock_name}' to resource group '{resource_group}'")
             else:
-                logger.error(f"Failed to restore lock '{lock_name}' to resource group '{resource_group}': {result}")
+                logger.error(f"Failed to restore lock '{lock_name}' to resource group '{resource_group}': {error}")
             progress.update(task, advance=1)
     return restored_locks
 
@@ -368,20 +669,28 @@ def generate_log_file(results, total_runtime):
     logs_dir = "logs"
     os.makedirs(logs_dir, exist_ok=True)
     log_filename = os.path.join(logs_dir, f"snapshot_deletion_log_{user_id}_{current_time}.txt")
+    lines = [
+        "Snapshot Deletion Log",
+        "=====================",
+        "",
+        f"User: {user_id}",
+        f"Date and Time: {current_time}",
+        "",
+        "Summary:",
+    ]
+    for subscription_name, data in results.items():
+        lines.extend([
+            "",
+            f"Subscription: {subscription_name}",
+            f"  Valid Snapshots: {len(data.get('valid', []))}",
+            f"  Non-existent Snapshots: {len(data.get('non-existent', []))}",
+            f"  Deleted Snapshots: {len(data.get('deleted', []))}",
+            f"  Failed Deletions: {len(data.get('failed', []))}",
+        ])
+    lines.extend(["", f"Total Runtime: {total_runtime:.2f} seconds", ""])
     try:
-        with open(log_filename, 'w') as log_file:
-            log_file.write("Snapshot Deletion Log\n")
-            log_file.write("=====================\n\n")
-            log_file.write(f"User: {user_id}\n")
-            log_file.write(f"Date and Time: {current_time}\n\n")
-            log_file.write("Summary:\n")
-            for subscription_name, data in results.items():
-                log_file.write(f"\nSubscription: {subscription_name}\n")
-                log_file.write(f"  Valid Snapshots: {len(data.get('valid', []))}\n")
-                log_file.write(f"  Non-existent Snapshots: {len(data.get('non-existent', []))}\n")
-                log_file.write(f"  Deleted Snapshots: {len(data.get('deleted', []))}\n")
-                log_file.write(f"  Failed Deletions: {len(data.get('failed', []))}\n")
-            log_file.write(f"\nTotal Runtime: {total_runtime:.2f} seconds\n")
+        with open(log_filename, 'w', buffering=1 << 20) as log_file:
+            log_file.write("\n".join(lines))
     except Exception as e:
         logger.error(f"Failed to write log file: {str(e)}")
         return None
@@ -422,6 +731,7 @@ async def main():
         logger.error("No subscriptions found. User may not be logged in.")
         console.print("[bold red]No subscriptions found. Please make sure you're logged in with 'az login'.[/bold red]")
         return
+    subscription_names = {sub['id']: sub['name'] for sub in subscriptions}
 
     all_snapshots = []
     start_time = time.time()
@@ -432,11 +742,19 @@ async def main():
     growing_table.add_column("Snapshots Found", style="magenta", header_style="bold magenta")
     growing_table.add_column("Status", style="green", header_style="bold green")
 
-    with Live(Panel(Group(overall_progress, growing_table)), refresh_per_second=4) as live:
-        for i, subscription in enumerate(subscriptions):
+    scan_semaphore = asyncio.Semaphore(MAX_CONCURRENT_SCANS)
+
+    async def scan(subscription):
+        async with scan_semaphore:
             logger.info(f"Searching in subscription: {subscription['name']}")
+            return subscription, await get_snapshots(subscription['id'], start_date, end_date, keyword)
+
+    with Live(Panel(Group(overall_progress, growing_table)), refresh_per_second=4) as live:
+        # All subscriptions are scanned concurrently; rows are added as each scan finishes
+        scans = [asyncio.create_task(scan(subscription)) for subscription in subscriptions]
+        for i, next_done in enumerate(asyncio.as_completed(scans)):
+            subscription, snapshots = await next_done
             overall_progress.update(overall_task, completed=(i+1)/len(subscriptions)*100, description=f"Searching subscriptions", subscription=f"{i+1}/{len(subscriptions)}")
-            snapshots = await get_snapshots(subscription['id'], start_date, end_date, keyword)
             all_snapshots.extend(snapshots)
             
             # Update the growing table
@@ -449,9 +767,11 @@ async def main():
 
     # Display detailed results
     console.print("\n[bold cyan]Detailed Results:[/bold cyan]")
+    snapshots_by_subscription = defaultdict(list)
+    for snapshot in all_snapshots:
+        snapshots_by_subscription[snapshot['_sub_id']].append(snapshot)
     for subscription in subscriptions:
-        subscription_snapshots = [s for s in all_snapshots if subscription['id'] in s['id']]
-        display_snapshots(subscription_snapshots, subscription['name'])
+        display_snapshots(snapshots_by_subscription.get(subscription['id'], []), subscription['name'])
 
     # Log sorted snapshots
     log_sorted_snapshots(all_snapshots)
@@ -473,14 +793,16 @@ async def main():
             writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
             writer.writeheader()
             for snapshot in all_snapshots:
-                snapshot['subscription'] = next(sub['name'] for sub in subscriptions if sub['id'] in snapshot['id'])
-                writer.writerow({k: snapshot.get(k, 'N/A') for k in fieldnames})
+                # Look the name up by subscription ID instead of scanning every subscription, and leave the snapshot untouched
+                row = {k: snapshot.get(k, 'N/A') for k in fieldnames}
+                row['subscription'] = subscription_names.get(snapshot['id'].split('/')[2], 'N/A')
+                writer.writerow(row)
         console.print(f"[green]Results exported to {filename}[/green]")
 
     # Ask if user wants to delete snapshots
     if Prompt.ask("Do you want to delete snapshots?", choices=["y", "n"], default="n") == "y":
         snapshot_ids_to_delete = [snapshot['id'] for snapshot in all_snapshots]
-        deletion_results = await delete_snapshots(snapshot_ids_to_delete)
+        deletion_results = await delete_snapshots(snapshot_ids_to_delete, subscription_names)
         
         if "error" in deletion_results:
             console.print(f"[bold red]Error during deletion: {deletion_results['error']}[/bold red]")
@@ -498,18 +820,18 @@ async def main():
     logger.info("Azure Snapshot Manager completed successfully")
 
 def log_sorted_snapshots(all_snapshots):
-    sorted_snapshots = defaultdict(lambda: defaultdict(list))
+    if not logger.isEnabledFor(logging.INFO):
+        return
+    sorted_snapshots = {}
     for snapshot in all_snapshots:
-        subscription_id = snapshot['id'].split('/')[2]
-        sorted_snapshots[subscription_id][snapshot['resourceGroup']].append(snapshot['id'])
+        sorted_snapshots.setdefault(snapshot['_sub_id'], {}).setdefault(snapshot['resourceGroup'], []).append(snapshot['id'])
 
     logger.info("Sorted Snapshot Resource IDs:")
     for subscription_id, resource_groups in sorted_snapshots.items():
         logger.info(f"Subscription: {subscription_id}")
+        # One record per resource group rather than one per snapshot ID
         for resource_group, snapshot_ids in resource_groups.items():
-            logger.info(f"  Resource Group: {resource_group}")
-            for snapshot_id in snapshot_ids:
-                logger.info(f"    {snapshot_id}")
+            logger.info("\n".join([f"  Resource Group: {resource_group}"] + [f"    {snapshot_id}" for snapshot_id in snapshot_ids]))
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file